@@ -0,0 +1,109 @@
+"""
+Compare /transcribe wall-clock time against audio duration with and without
+silence-based segmentation.
+
+Gemini is replaced by an in-process fake whose latency grows linearly with
+the duration of the audio it receives, so no API keys or network access are
+needed. The input is synthetic "speech": bursts of noise separated by short
+pauses.
+
+    python benchmarks/long_audio_transcription.py --durations 30 120 300 600
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+os.environ.setdefault("google_api_key_gemini", "benchmark")
+os.environ.setdefault("DEEPGRAM_WARMUP_CONNECTIONS", "0")
+os.chdir(tempfile.mkdtemp(prefix="transcribe-bench-"))
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+import soundfile as sf  # noqa: E402
+import main  # noqa: E402
+
+
+def install_fake_gemini(base_latency: float, latency_per_second: float):
+    async def generate_content(**kwargs):
+        audio = kwargs["contents"][0].inline_data.data
+        duration = sf.info(io.BytesIO(audio)).duration
+        await asyncio.sleep(base_latency + latency_per_second * duration)
+
+        class Response:
+            text = "benchmark transcription"
+        return Response()
+
+    main.client.aio.models.generate_content = generate_content
+
+
+def synthetic_speech(seconds: float, sample_rate: int, seed: int) -> bytes:
+    """FLAC-encoded noise bursts of 2-6 s separated by 0.3-0.8 s pauses."""
+    rng = np.random.default_rng(seed)
+    parts, total = [], 0
+    while total < seconds * sample_rate:
+        burst = rng.normal(0, 0.2, int(rng.uniform(2, 6) * sample_rate))
+        pause = rng.normal(0, 0.002, int(rng.uniform(0.3, 0.8) * sample_rate))
+        parts += [burst, pause]
+        total += len(burst) + len(pause)
+    samples = np.concatenate(parts)[:int(seconds * sample_rate)].astype("float32")
+    buffer = io.BytesIO()
+    sf.write(buffer, samples, sample_rate, format="FLAC")
+    return buffer.getvalue()
+
+
+async def time_transcription(client: httpx.AsyncClient, audio: bytes) -> tuple[float, int]:
+    start = time.perf_counter()
+    response = await client.post("/transcribe/", files={"file": ("clip.flac", audio, "audio/flac")})
+    elapsed = time.perf_counter() - start
+    body = response.json()
+    assert not body["cached"], body
+    return elapsed, body["segments"]
+
+
+async def run(args):
+    install_fake_gemini(args.base_latency, args.latency_per_second)
+    # Keep every request on the inline path so only segmentation differs
+    main.TRANSCRIBE_INLINE_MAX_BYTES = float("inf")
+    segment_min_seconds = main.TRANSCRIBE_SEGMENT_MIN_SECONDS
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for seed, duration in enumerate(args.durations):
+            audio = synthetic_speech(duration, args.sample_rate, seed)
+            main.transcript_cache.memory.clear()
+
+            main.TRANSCRIBE_SEGMENT_MIN_SECONDS = float("inf")
+            before, _ = await time_transcription(client, audio)
+            # A different key so the second run is not a transcript cache hit
+            main.TRANSCRIBE_PROMPT_VERSION += "-bench"
+            main.TRANSCRIBE_SEGMENT_MIN_SECONDS = segment_min_seconds
+            after, segments = await time_transcription(client, audio)
+            if duration > segment_min_seconds:
+                assert segments > 1, f"{duration} s recording was not segmented"
+
+            results.append({
+                "duration_s": duration,
+                "whole_file_s": round(before, 3),
+                "segmented_s": round(after, 3),
+                "segments": segments,
+                "speedup": round(before / after, 2),
+            })
+
+    print(json.dumps({"config": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--durations", type=float, nargs="+", default=[30, 60, 120, 300, 600], help="audio durations in seconds")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--base-latency", type=float, default=0.5, help="fake Gemini latency per call in seconds")
+    parser.add_argument("--latency-per-second", type=float, default=0.01, help="fake Gemini latency per second of audio")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,130 @@
+"""
+Measure cold-start cost: how long `import main` takes and how long until the app answers.
+
+Every run starts a fresh interpreter. The import profile comes from
+`python -X importtime` and lists the modules with the largest cumulative
+import time. With --max-import-seconds the script exits non-zero when the
+median import of main exceeds the budget, so regressions can fail CI.
+
+    python benchmarks/startup_time.py --runs 5 --top 15
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Libraries main should only load on first use
+HEAVY_MODULES = ("numpy", "soundfile", "deepgram", "google.genai", "uvicorn")
+
+IMPORT_SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(elapsed, *[name for name in {HEAVY_MODULES!r} if name in sys.modules])
+"""
+
+
+def child_env() -> dict:
+    env = dict(os.environ, PYTHONPATH=REPO)
+    env.setdefault("DEEPGRAM_API_KEY", "benchmark")
+    env.setdefault("google_api_key_gemini", "benchmark")
+    env.setdefault("DEEPGRAM_WARMUP_CONNECTIONS", "0")
+    return env
+
+
+def measure_import(workdir: str) -> tuple[float, list[str]]:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=workdir, env=child_env(),
+        capture_output=True, text=True, check=True,
+    ).stdout.split()
+    return float(output[0]), output[1:]
+
+
+def measure_ready(workdir: str, timeout: float) -> float:
+    """Seconds from spawning uvicorn until GET /stats succeeds."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=child_env(),
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/stats").status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise TimeoutError(f"app did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def import_profile(workdir: str, top: int) -> list[dict]:
+    """Modules with the largest cumulative import time, from -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir, env=child_env(),
+        capture_output=True, text=True, check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({
+            "module": name.strip(),
+            "cumulative_ms": round(int(cumulative_us) / 1000, 1),
+            "self_ms": round(int(self_us) / 1000, 1),
+        })
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:top]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "median_s": round(statistics.median(samples), 4),
+        "min_s": round(min(samples), 4),
+        "max_s": round(max(samples), 4),
+    }
+
+
+def main(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="tts-startup-")
+    # The first run compiles bytecode; leave it out of the numbers
+    measure_import(workdir)
+    imports = [measure_import(workdir) for _ in range(args.runs)]
+    ready = [measure_ready(workdir, args.timeout) for _ in range(args.runs)]
+
+    report = {
+        "import_main": summarize([seconds for seconds, _ in imports]),
+        "heavy_modules_loaded_at_import": imports[-1][1],
+        "ready": summarize(ready),
+        "import_profile": import_profile(workdir, args.top),
+        "config": vars(args),
+    }
+    print(json.dumps(report, indent=2))
+    if args.max_import_seconds and report["import_main"]["median_s"] > args.max_import_seconds:
+        print(f"import main took longer than {args.max_import_seconds}s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=15, help="modules listed in the import profile")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the app to answer")
+    parser.add_argument("--max-import-seconds", type=float, help="fail if the median import of main is slower")
+    sys.exit(main(parser.parse_args()))
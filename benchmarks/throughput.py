@@ -0,0 +1,197 @@
+"""
+Measure /tts and /transcribe latency and throughput against local fakes.
+
+A stub server imitating the Deepgram speak endpoint and the Gemini
+generateContent endpoint runs on a local port, with configurable latency
+and payload size, so the real pooled Deepgram client and the real Gemini
+SDK are exercised without API keys or network access. The app itself runs
+under uvicorn on another local port. Each workload is driven at fixed
+concurrency levels and the report is printed (or written) as JSON. The
+shared_hit workload points TTS_SHARED_STORE at a temporary directory and
+requests texts found only there, standing in for another replica's upload.
+
+    python benchmarks/throughput.py --concurrency 1 8 32 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+WORKLOADS = ("cache_hit", "cache_miss", "shared_hit", "transcribe")
+
+
+def build_stub_app(args) -> Starlette:
+    """Fake Deepgram and Gemini APIs with fixed latency and payload size."""
+    audio = b"\xff\xfb" + b"\0" * max(0, args.deepgram_bytes - 2)
+
+    async def speak(request):
+        await request.body()
+        await asyncio.sleep(args.deepgram_latency)
+
+        async def chunks():
+            for start in range(0, len(audio), 16 * 1024):
+                yield audio[start:start + 16 * 1024]
+
+        return StreamingResponse(chunks(), media_type="audio/mpeg")
+
+    async def generate_content(request):
+        await request.body()
+        await asyncio.sleep(args.gemini_latency)
+        text = "benchmark " * max(1, args.transcript_words)
+        return JSONResponse({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text.strip()}]}, "finish_reason": "STOP"}],
+        })
+
+    return Starlette(routes=[
+        Route("/v1/speak", speak, methods=["POST", "HEAD"]),
+        Route("/{version}/models/{model}:generateContent", generate_content, methods=["POST"]),
+    ])
+
+
+def start_server(app) -> tuple[uvicorn.Server, str]:
+    """Serve app on a free local port from a background thread."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(send, requests: int, concurrency: int) -> dict:
+    """Issue requests calls of send(i) from concurrency workers and summarize them."""
+    latencies = []
+    errors = 0
+    next_index = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in next_index:
+            start = time.perf_counter()
+            try:
+                response = await send(i)
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+async def run(args):
+    import httpx
+
+    stub_server, stub_url = start_server(build_stub_app(args))
+    # main reads its settings and builds its clients at import time
+    os.environ["DEEPGRAM_URL"] = stub_url
+    import main
+    from google import genai
+    from google.genai import types
+    main.client = genai.Client(api_key="benchmark", http_options=types.HttpOptions(base_url=stub_url))
+
+    server, base_url = start_server(main.app)
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    run_id = uuid.uuid4().hex[:8]
+    audio = os.urandom(args.audio_bytes)
+
+    def shared_hit_sender(client, level):
+        # Every text is in the shared store and in no local cache, and is used once
+        texts = [f"Shared {run_id} {level} {i}" for i in range(args.requests + level)]
+        seed_path = os.path.abspath("shared-seed.mp3")
+        with open(seed_path, "wb") as f:
+            f.write(b"\xff\xfb" + b"\0" * max(0, args.deepgram_bytes - 2))
+        for text in texts:
+            main.shared_storage.upload(seed_path, main.compute_cache_filename(text, main.TTSRequest(text=text).model))
+        next_text = iter(texts)
+        return lambda i: client.post("/tts", json={"text": next(next_text)})
+
+    senders = {
+        "cache_hit": lambda client, level: lambda i: client.post("/tts", json={"text": "Please hold."}),
+        # Unique single-sentence texts, so every request is a Deepgram call
+        "cache_miss": lambda client, level: lambda i: client.post("/tts", json={"text": f"Miss {run_id} {level} {i}"}),
+        "shared_hit": shared_hit_sender,
+        # Random audio keeps every upload out of the transcript cache
+        "transcribe": lambda client, level: lambda i: client.post(
+            "/transcribe/", files={"file": ("clip.wav", os.urandom(16) + audio, "audio/wav")}),
+    }
+
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+        await client.post("/tts", json={"text": "Please hold."})
+        for workload in args.workloads:
+            for level in args.concurrency:
+                send = senders[workload](client, level)
+                # Warm up pooled connections before measuring
+                await drive(send, level, level)
+                shared_hits = main.stats["tts_shared_hits"]
+                result = {"workload": workload, **await drive(send, args.requests, level)}
+                if workload == "shared_hit":
+                    result["shared_hits"] = main.stats["tts_shared_hits"] - shared_hits
+                results.append(result)
+    server.should_exit = True
+    stub_server.should_exit = True
+
+    report = {"results": results, "config": vars(args)}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32], help="concurrency levels to run")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per workload and level")
+    parser.add_argument("--deepgram-latency", type=float, default=0.2, help="fake Deepgram latency in seconds")
+    parser.add_argument("--deepgram-bytes", type=int, default=32 * 1024, help="fake Deepgram audio size")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="fake Gemini latency in seconds")
+    parser.add_argument("--transcript-words", type=int, default=50, help="words in each fake transcription")
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024, help="size of each uploaded clip")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+    os.environ.setdefault("google_api_key_gemini", "benchmark")
+    os.environ.setdefault("DEEPGRAM_WARMUP_CONNECTIONS", "0")
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    os.chdir(tempfile.mkdtemp(prefix="tts-bench-"))
+    if "shared_hit" in args.workloads:
+        os.environ["TTS_SHARED_STORE"] = os.path.abspath("shared")
+    asyncio.run(run(args))
@@ -0,0 +1,122 @@
+"""
+Measure /tts cache-hit latency while /transcribe calls are in flight.
+
+The app runs under uvicorn on a local port in a background thread, and
+Gemini is replaced by an in-process fake with a fixed latency, so no API
+keys or network access are needed. With --blocking the fake sleeps on the
+event loop, reproducing the old synchronous generate_content call.
+
+    python benchmarks/tts_under_transcription_load.py --transcriptions 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import socket
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+os.environ.setdefault("google_api_key_gemini", "benchmark")
+os.environ.setdefault("DEEPGRAM_WARMUP_CONNECTIONS", "0")
+os.chdir(tempfile.mkdtemp(prefix="tts-bench-"))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+import main  # noqa: E402
+
+
+class FakeResponse:
+    text = "benchmark transcription"
+
+
+def install_fake_gemini(latency: float, blocking: bool):
+    async def generate_content(**kwargs):
+        if blocking:
+            time.sleep(latency)
+        else:
+            await asyncio.sleep(latency)
+        return FakeResponse()
+
+    main.client.aio.models.generate_content = generate_content
+
+
+def start_server() -> tuple[uvicorn.Server, str]:
+    """Serve main.app on a free local port from a background thread."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure_cache_hits(client: httpx.AsyncClient, payload: dict, count: int) -> list[float]:
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await client.post("/tts", json=payload)
+        latencies.append(time.perf_counter() - start)
+        assert response.json()["cached"], response.text
+    return latencies
+
+
+async def run(args):
+    install_fake_gemini(args.gemini_latency, args.blocking)
+    payload = {"text": "Please hold.", "model": "aura-2-thalia-en"}
+    cached = os.path.join(main.audio_folder, main.compute_cache_filename(payload["text"], payload["model"]))
+    with open(cached, "wb") as f:
+        f.write(b"\0" * 1024)
+
+    server, base_url = start_server()
+    limits = httpx.Limits(max_connections=args.transcriptions + 1)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+        idle = await measure_cache_hits(client, payload, args.requests)
+
+        done = asyncio.Event()
+
+        async def keep_transcribing():
+            # Keep one transcription in flight per worker until measuring ends.
+            # Random audio keeps every upload out of the transcript cache.
+            while not done.is_set():
+                files = {"file": ("clip.wav", os.urandom(1024), "audio/wav")}
+                await client.post("/transcribe/", files=files)
+
+        background = [asyncio.create_task(keep_transcribing()) for _ in range(args.transcriptions)]
+        await asyncio.sleep(args.gemini_latency / 2)
+        loaded = await measure_cache_hits(client, payload, args.requests)
+        done.set()
+        await asyncio.gather(*background)
+    server.should_exit = True
+
+    report = {}
+    for name, samples in (("idle", idle), ("under_load", loaded)):
+        report[name] = {
+            "requests": len(samples),
+            "p50_ms": round(statistics.median(samples) * 1000, 3),
+            "p95_ms": round(percentile(samples, 95) * 1000, 3),
+            "max_ms": round(max(samples) * 1000, 3),
+        }
+    report["config"] = vars(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=50, help="cache-hit requests per phase")
+    parser.add_argument("--transcriptions", type=int, default=16, help="concurrent transcriptions in flight")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="fake Gemini latency in seconds")
+    parser.add_argument("--blocking", action="store_true", help="simulate the old blocking Gemini call")
+    asyncio.run(run(parser.parse_args()))
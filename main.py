@@ -1,23 +1,94 @@
+from __future__ import annotations
+
 import os
+import sys
+import asyncio
 import hashlib
+import re
+import unicodedata
+import tempfile
+import shutil
+import threading
+import mimetypes
+import csv
+import hmac
+import contextvars
+import importlib
+import heapq
+import itertools
+import math
+from abc import ABC, abstractmethod
+from email.utils import formatdate
+from typing import TYPE_CHECKING, Literal
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.formparsers import MultiPartParser
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
+from pydantic import BaseModel, Field, model_validator
 from fastapi.concurrency import run_in_threadpool
-from deepgram import DeepgramClient, SpeakOptions
+import httpx
+import anyio
 from dotenv import load_dotenv
-from google import genai
-from google.genai import types
-import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
-import numpy as np
-import soundfile as sf
 import io
+import json
 import time
+import logging
+from contextlib import nullcontext
+if TYPE_CHECKING:
+    from google.genai import types
 load_dotenv(override=True)
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+class LazyModule:
+    """Stand-in for a module that is only imported on first attribute access."""
+
+    def __init__(self, name: str):
+        self._lazy_name = name
+
+    def __getattr__(self, attr: str):
+        value = getattr(importlib.import_module(self._lazy_name), attr)
+        setattr(self, attr, value)
+        return value
+
+# Audio libraries, the Deepgram SDK and the Gemini SDK are loaded on first
+# use rather than at import time, to keep cold starts fast
+np = LazyModule("numpy")
+sf = LazyModule("soundfile")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Index the existing cache from its manifest (listing the folder only if
+    # there is none yet), and start enforcing its size and age limits. Temp
+    # files left behind by a crash are removed by the background reconcile.
+    if not await run_in_threadpool(tts_cache.load):
+        await run_in_threadpool(tts_cache.scan)
+    reconcile_task = asyncio.create_task(run_index_reconcile())
+    eviction_task = asyncio.create_task(run_cache_eviction())
+    # Open pooled Deepgram connections before the first cache miss needs them
+    warmup_task = asyncio.create_task(warm_up_deepgram())
+    # Load the lazily imported libraries in the background once serving has started
+    preload_task = asyncio.create_task(run_in_threadpool(preload)) if PRELOAD_ON_STARTUP else None
+    yield
+    if preload_task is not None:
+        preload_task.cancel()
+    warmup_task.cancel()
+    eviction_task.cancel()
+    reconcile_task.cancel()
+    await run_in_threadpool(tts_cache.save)
+    for job in prewarm_jobs.values():
+        job.task.cancel()
+    if "deepgram_http" in globals():
+        await deepgram_http.aclose()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -25,92 +96,2912 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles that reports every served audio file to the TTS cache manager
+    and serves whole-file GETs of hot clips from the in-memory tier.
+    Range requests always go to disk. Files are found in their shard whether
+    they are requested as /static/ab/cd/<hash>.mp3 or by the old flat URL
+    /static/<hash>.mp3, and in the flat folder until they have been migrated.
+    """
+
+    async def get_response(self, path: str, scope):
+        filename = os.path.basename(path)
+        request_headers = Headers(scope=scope)
+        from_memory = scope["method"] == "GET" and "range" not in request_headers and self.is_cache_path(path)
+        if from_memory:
+            clip = hot_audio.get(filename)
+            if clip is not None:
+                tts_cache.touch(filename)
+                # Same validators as the disk response, so either tier answers conditional GETs
+                if self.is_not_modified(Headers(clip.headers), request_headers):
+                    return NotModifiedResponse(Headers(clip.headers))
+                return Response(clip.data, media_type=audio_media_type(filename), headers=clip.headers)
+
+        try:
+            response = await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            if e.status_code == 404 and filename in tts_cache:
+                # Indexed but gone from disk; the next /tts synthesizes it again
+                tts_cache.forget(filename)
+            raise
+        if response.status_code == 200:
+            tts_cache.touch(filename)
+            if from_memory and isinstance(response, FileResponse):
+                # Promote the clip so the next request is served from RAM
+                await run_in_threadpool(load_hit, filename)
+        return response
+
+    def is_cache_path(self, path: str) -> bool:
+        """Whether path is the sharded or old flat URL path of a cache file."""
+        return os.path.dirname(path) in ("", shard_dir(os.path.basename(path)))
+
+    def lookup_path(self, path: str):
+        filename = os.path.basename(path)
+        if not self.is_cache_path(path):
+            return super().lookup_path(path)
+        # Sharded and old flat URLs both resolve to wherever the file is now
+        for candidate in cache_file_candidates("", filename):
+            full_path, stat_result = super().lookup_path(candidate)
+            if stat_result is not None:
+                return full_path, stat_result
+        return "", None
+
 # Create and mount a static folder to serve saved audio files
 audio_folder = "static"
 os.makedirs(audio_folder, exist_ok=True)
-app.mount("/static", StaticFiles(directory=audio_folder), name="static")
+app.mount("/static", CachedStaticFiles(directory=audio_folder), name="static")
 
 # Define the request body model
 class TTSRequest(BaseModel):
     text: str
     model: str = "aura-2-thalia-en"  # default voice model
+    # Output format, passed through to Deepgram; unset values use Deepgram's defaults
+    encoding: Literal["mp3", "opus", "linear16", "mulaw", "alaw", "flac", "aac"] = "mp3"
+    sample_rate: int | None = Field(default=None, gt=0)
+    bitrate: int | None = Field(default=None, gt=0)
+
+    @model_validator(mode="after")
+    def check_format(self):
+        # Reject what Deepgram would reject, so a request fails the same way
+        # whether or not it could have been transcoded from a cached master
+        rates = ENCODING_SAMPLE_RATES[self.encoding]
+        default_rate, default_bitrate = ENCODING_DEFAULTS[self.encoding]
+        if self.sample_rate not in (None, default_rate) and self.sample_rate not in rates:
+            allowed = ", ".join(map(str, rates)) if rates else f"only {default_rate}"
+            raise ValueError(f"sample_rate for {self.encoding} must be one of: {allowed}")
+        bitrates = ENCODING_BITRATES[self.encoding]
+        if self.bitrate not in (None, default_bitrate) and self.bitrate not in bitrates:
+            if not bitrates:
+                raise ValueError(f"bitrate cannot be set for {self.encoding}")
+            if isinstance(bitrates, range):
+                raise ValueError(f"bitrate for {self.encoding} must be between {bitrates.start} and {bitrates.stop - 1}")
+            raise ValueError(f"bitrate for {self.encoding} must be one of: {', '.join(map(str, bitrates))}")
+        return self
+
+    def audio_format(self) -> AudioFormat:
+        return AudioFormat.of(self.encoding, self.sample_rate, self.bitrate)
 
 # Load Deepgram API key from environment variable
 DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
 if not DEEPGRAM_API_KEY:
     raise RuntimeError("DEEPGRAM_API_KEY environment variable is not set.")
-deepgram = DeepgramClient(DEEPGRAM_API_KEY)
 
-def compute_cache_filename(text: str, model: str) -> str:
-    """Compute a SHA256 hash from text and model, and return a filename for caching."""
-    hash_object = hashlib.sha256(f"{model}:{text}".encode())
-    return hash_object.hexdigest() + ".mp3"
+# Shared async HTTP client for Deepgram, so cache misses reuse pooled
+# keep-alive connections instead of paying a TLS handshake each time
+DEEPGRAM_URL = os.getenv("DEEPGRAM_URL", "https://api.deepgram.com")
+DEEPGRAM_POOL_SIZE = int(os.getenv("DEEPGRAM_POOL_SIZE", "20"))
+DEEPGRAM_TIMEOUT = float(os.getenv("DEEPGRAM_TIMEOUT", "30"))
+DEEPGRAM_CONNECT_TIMEOUT = float(os.getenv("DEEPGRAM_CONNECT_TIMEOUT", "10"))
+DEEPGRAM_KEEPALIVE_SECONDS = float(os.getenv("DEEPGRAM_KEEPALIVE_SECONDS", "60"))
+DEEPGRAM_WARMUP_CONNECTIONS = int(os.getenv("DEEPGRAM_WARMUP_CONNECTIONS", "2"))
+
+def create_deepgram_http() -> httpx.AsyncClient:
+    """Build the pooled Deepgram client, using HTTP/2 when the h2 package is installed."""
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        base_url=DEEPGRAM_URL,
+        http2=http2,
+        headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"},
+        limits=httpx.Limits(
+            max_connections=DEEPGRAM_POOL_SIZE,
+            max_keepalive_connections=DEEPGRAM_POOL_SIZE,
+            keepalive_expiry=DEEPGRAM_KEEPALIVE_SECONDS,
+        ),
+        timeout=httpx.Timeout(DEEPGRAM_TIMEOUT, connect=DEEPGRAM_CONNECT_TIMEOUT),
+    )
+
+def get_deepgram_http() -> httpx.AsyncClient:
+    """The pooled Deepgram client, built on first use. Event loop only."""
+    global deepgram_http
+    if "deepgram_http" not in globals():
+        deepgram_http = create_deepgram_http()
+    return deepgram_http
+
+async def warm_up_deepgram():
+    """Open DEEPGRAM_WARMUP_CONNECTIONS pooled connections. Failures are only logged."""
+    async def open_connection():
+        try:
+            await get_deepgram_http().head("/v1/speak")
+        except httpx.HTTPError as e:
+            logger.warning("Deepgram warm-up failed: %s", e)
+    await asyncio.gather(*(open_connection() for _ in range(DEEPGRAM_WARMUP_CONNECTIONS)))
+
+class UpstreamError(RuntimeError):
+    """An upstream API answered with an error status."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float = None):
+        super().__init__(f"Upstream returned {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+        # Seconds from the Retry-After header, if the upstream sent one
+        self.retry_after = retry_after
 
-def generate_and_save_tts(text: str, model: str, file_path: str):
+class UpstreamThrottled(RuntimeError):
+    """A request was turned away by the client-side limiter, or rate limited by the upstream on every attempt."""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+def parse_retry_after(value: str | None) -> float | None:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None  # an HTTP date; fall back to the default backoff
+
+async def open_speak_stream(text: str, model: str, fmt: AudioFormat = None) -> httpx.Response:
     """
-    Generate TTS audio from text using Deepgram and save it to file_path.
-    This function uses the .save() method to write the audio to disk.
+    Start a Deepgram speak request on the pooled client and return the
+    streaming response once the status is known. The caller must close it.
+    Upstream latency is recorded up to the response headers.
     """
-    options = SpeakOptions(model=model)
-    speak_options = {"text": text}
-    # Using the save method to write the file directly to disk.
-    response = deepgram.speak.rest.v("1").save(file_path, speak_options, options)
+    from deepgram import SpeakOptions
+
+    options = SpeakOptions(model=model, **(fmt or DEFAULT_FORMAT).speak_options())
+    http = get_deepgram_http()
+    request = http.build_request("POST", "/v1/speak", params=options.to_dict(), json={"text": text})
+    async with track_upstream("deepgram", "speak"):
+        response = await http.send(request, stream=True)
+        if response.status_code != 200:
+            detail = (await response.aread()).decode(errors="replace")
+            await response.aclose()
+            raise UpstreamError(response.status_code, detail, parse_retry_after(response.headers.get("retry-after")))
     return response
 
+# Client-side admission control for Deepgram speak requests, so bursts of
+# cache misses queue here instead of being rejected with 429s. A token bucket
+# caps the request rate (DEEPGRAM_RATE_LIMIT per second, bursts of up to
+# DEEPGRAM_RATE_BURST; 0 disables it) and an AIMD limit caps requests in
+# flight: it grows by about one per round of successful requests up to
+# DEEPGRAM_MAX_CONCURRENCY and halves on a 429, down to
+# DEEPGRAM_MIN_CONCURRENCY. A 429 also pauses new requests for its
+# Retry-After, and the throttled request is queued again.
+DEEPGRAM_RATE_LIMIT = float(os.getenv("DEEPGRAM_RATE_LIMIT", "0"))
+DEEPGRAM_RATE_BURST = int(os.getenv("DEEPGRAM_RATE_BURST", "10"))
+DEEPGRAM_MIN_CONCURRENCY = int(os.getenv("DEEPGRAM_MIN_CONCURRENCY", "1"))
+DEEPGRAM_MAX_CONCURRENCY = int(os.getenv("DEEPGRAM_MAX_CONCURRENCY", str(DEEPGRAM_POOL_SIZE)))
+# Requests waiting for a slot; beyond this they fail with a 503
+DEEPGRAM_QUEUE_SIZE = int(os.getenv("DEEPGRAM_QUEUE_SIZE", "256"))
+DEEPGRAM_THROTTLE_RETRIES = int(os.getenv("DEEPGRAM_THROTTLE_RETRIES", "3"))
+# Pause after a 429 without a Retry-After header
+DEEPGRAM_THROTTLE_BACKOFF_SECONDS = float(os.getenv("DEEPGRAM_THROTTLE_BACKOFF_SECONDS", "1"))
+
+# Queued requests start in priority order: live requests first, then
+# /tts/batch, then catalog pre-warming
+PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_PREWARM = 0, 1, 2
+# Priority of the Deepgram requests made on behalf of the current task
+synthesis_priority: contextvars.ContextVar[int] = contextvars.ContextVar("synthesis_priority", default=PRIORITY_INTERACTIVE)
+
+@dataclass
+class LimiterSlot:
+    limiter: AdaptiveLimiter
+    started: float
+    released: bool = False
+
+    def release(self, throttled: bool = False, retry_after: float = None):
+        """Give the slot back, reporting whether the upstream throttled the request. Idempotent."""
+        if not self.released:
+            self.released = True
+            self.limiter.release(self, throttled, retry_after)
+
+class AdaptiveLimiter:
+    """
+    Token bucket plus AIMD concurrency limit in front of an upstream API.
+    Requests that cannot start yet wait in a bounded queue, lowest priority
+    value first and FIFO within a priority. Event loop only.
+    """
+
+    def __init__(self, rate: float, burst: int, min_limit: int, max_limit: int, queue_size: int):
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.queue_size = queue_size
+        self.limit = float(self.max_limit)
+        self.inflight = 0
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        # Heap of (priority, arrival, future)
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.arrivals = itertools.count()
+        self.timer = None
+
+    def delay(self) -> float | None:
+        """Seconds until a request may start (0 if it may start now), or None while the concurrency limit is reached."""
+        if self.inflight >= int(self.limit):
+            return None
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0.0
+
+    def take(self) -> LimiterSlot:
+        self.inflight += 1
+        if self.rate:
+            self.tokens -= 1
+        return LimiterSlot(self, time.monotonic())
+
+    def dispatch(self):
+        """Start queued requests while the limits allow, waking up later if only the rate holds them back."""
+        while self.waiters:
+            future = self.waiters[0][2]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            delay = self.delay()
+            if delay is None:
+                return  # the next release dispatches again
+            if delay > 0:
+                if self.timer is None:
+                    self.timer = asyncio.get_running_loop().call_later(delay, self.on_timer)
+                return
+            heapq.heappop(self.waiters)
+            future.set_result(self.take())
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> LimiterSlot:
+        """Wait for a slot. Raises UpstreamThrottled if the queue is full."""
+        if not self.waiters and self.delay() == 0:
+            return self.take()
+        if len(self.waiters) >= self.queue_size:
+            stats["deepgram_queue_rejections"] += 1
+            retry_after = max(DEEPGRAM_THROTTLE_BACKOFF_SECONDS, self.paused_until - time.monotonic())
+            raise UpstreamThrottled("Too many Deepgram requests queued", retry_after)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrivals), future))
+        self.dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+                heapq.heapify(self.waiters)
+            else:
+                # The slot was granted just as the wait was cancelled
+                future.result().release()
+            raise
+
+    def release(self, slot: LimiterSlot, throttled: bool, retry_after: float = None):
+        self.inflight -= 1
+        now = time.monotonic()
+        if throttled:
+            self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else DEEPGRAM_THROTTLE_BACKOFF_SECONDS))
+            # Requests already in flight at the last decrease were sent under
+            # the old limit; their 429s do not halve it again
+            if slot.started >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.dispatch()
+
+deepgram_limiter = AdaptiveLimiter(
+    DEEPGRAM_RATE_LIMIT, DEEPGRAM_RATE_BURST, DEEPGRAM_MIN_CONCURRENCY, DEEPGRAM_MAX_CONCURRENCY, DEEPGRAM_QUEUE_SIZE,
+)
+
+async def request_speech(text: str, model: str, fmt: AudioFormat = None) -> tuple[httpx.Response, LimiterSlot]:
+    """
+    Open a Deepgram speak stream once deepgram_limiter has a slot for it,
+    queueing it again after a 429. The caller must close the response and
+    then release the slot.
+    """
+    for attempt in range(DEEPGRAM_THROTTLE_RETRIES + 1):
+        slot = await deepgram_limiter.acquire(synthesis_priority.get())
+        try:
+            return await open_speak_stream(text, model, fmt), slot
+        except UpstreamError as e:
+            if e.status_code != 429:
+                slot.release()
+                raise
+            stats["deepgram_throttled"] += 1
+            slot.release(throttled=True, retry_after=e.retry_after)
+            if attempt == DEEPGRAM_THROTTLE_RETRIES:
+                raise UpstreamThrottled(str(e), e.retry_after or DEEPGRAM_THROTTLE_BACKOFF_SECONDS) from e
+        except BaseException:
+            slot.release()
+            raise
+
+def synthesis_error(e: Exception) -> HTTPException:
+    """
+    The HTTP error for a failed synthesis:
+      - 503 with Retry-After when throttled
+      - 400 when Deepgram rejected the request itself (e.g. text it cannot synthesize)
+      - 502 for any other Deepgram error status
+      - 500 otherwise
+    """
+    if isinstance(e, UpstreamThrottled):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    if isinstance(e, UpstreamError):
+        return HTTPException(status_code=400 if e.status_code in (400, 413, 422) else 502, detail=str(e))
+    return HTTPException(status_code=500, detail=str(e))
+
+def env_flag(name: str, default: bool) -> bool:
+    """Read a boolean setting from the environment."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+# Canonicalization applied to texts before hashing and synthesis, so
+# near-identical inputs share one cache entry
+TTS_NORMALIZE_WHITESPACE = env_flag("TTS_NORMALIZE_WHITESPACE", True)
+TTS_NORMALIZE_UNICODE = env_flag("TTS_NORMALIZE_UNICODE", True)
+TTS_NORMALIZE_TRAILING_PUNCTUATION = env_flag("TTS_NORMALIZE_TRAILING_PUNCTUATION", False)
+TTS_NORMALIZE_CASE = env_flag("TTS_NORMALIZE_CASE", False)
+WHITESPACE_RUN = re.compile(r"\s+")
+TRAILING_PUNCTUATION = re.compile(r"[\s.,;:!?\u2026]+$")
+
+def normalize_text(text: str) -> str:
+    """
+    Return the canonical form of text used for the cache key and synthesis:
+      - Unicode NFC composition
+      - whitespace runs collapsed to one space and ends stripped
+      - (optional) trailing punctuation removed
+      - (optional) case folded
+    """
+    if TTS_NORMALIZE_UNICODE:
+        text = unicodedata.normalize("NFC", text)
+    if TTS_NORMALIZE_WHITESPACE:
+        text = WHITESPACE_RUN.sub(" ", text).strip()
+    if TTS_NORMALIZE_TRAILING_PUNCTUATION:
+        text = TRAILING_PUNCTUATION.sub("", text) or text
+    if TTS_NORMALIZE_CASE:
+        text = text.casefold()
+    return text
+
+# Deepgram's default sample rate and bitrate (None: not applicable) per encoding
+ENCODING_DEFAULTS = {
+    "mp3": (22050, 48000),
+    "opus": (48000, 12000),
+    "aac": (22050, 48000),
+    "linear16": (24000, None),
+    "mulaw": (8000, None),
+    "alaw": (8000, None),
+    "flac": (48000, None),
+}
+# Sample rates Deepgram accepts per encoding (empty: fixed at the default)
+ENCODING_SAMPLE_RATES = {
+    "mp3": (),
+    "opus": (),
+    "aac": (),
+    "linear16": (8000, 16000, 24000, 32000, 48000),
+    "mulaw": (8000, 16000),
+    "alaw": (8000, 16000),
+    "flac": (8000, 16000, 22050, 32000, 48000),
+}
+# Bitrates Deepgram accepts per encoding (empty: not configurable)
+ENCODING_BITRATES = {
+    "mp3": (32000, 48000),
+    "opus": range(4000, 650001),
+    "aac": range(4000, 192001),
+    "linear16": (),
+    "mulaw": (),
+    "alaw": (),
+    "flac": (),
+}
+# File extension and media type of what Deepgram returns for each encoding
+# (Opus comes in an Ogg container, PCM and G.711 in a WAV container)
+ENCODING_FILES = {
+    "mp3": ("mp3", "audio/mpeg"),
+    "opus": ("ogg", "audio/ogg"),
+    "aac": ("aac", "audio/aac"),
+    "linear16": ("wav", "audio/wav"),
+    "mulaw": ("wav", "audio/wav"),
+    "alaw": ("wav", "audio/wav"),
+    "flac": ("flac", "audio/flac"),
+}
+
+@dataclass(frozen=True)
+class AudioFormat:
+    """A TTS output format, with Deepgram's defaults filled in so equal formats compare equal."""
+    encoding: str
+    sample_rate: int
+    bitrate: int | None
+
+    @classmethod
+    def of(cls, encoding: str, sample_rate: int = None, bitrate: int = None) -> AudioFormat:
+        default_rate, default_bitrate = ENCODING_DEFAULTS[encoding]
+        return cls(encoding, sample_rate or default_rate, (bitrate or default_bitrate) if default_bitrate else None)
+
+    @property
+    def extension(self) -> str:
+        return ENCODING_FILES[self.encoding][0]
+
+    @property
+    def media_type(self) -> str:
+        return ENCODING_FILES[self.encoding][1]
+
+    @property
+    def label(self) -> str:
+        """Compact form recorded in the cache index, e.g. "mulaw:8000" or "mp3:22050:48000"."""
+        return ":".join(str(part) for part in (self.encoding, self.sample_rate, self.bitrate) if part)
+
+    def speak_options(self) -> dict:
+        """SpeakOptions fields for this format, leaving out Deepgram's defaults."""
+        default_rate, default_bitrate = ENCODING_DEFAULTS[self.encoding]
+        options = {}
+        if self.encoding != "mp3":
+            options["encoding"] = self.encoding
+        if self.sample_rate != default_rate:
+            options["sample_rate"] = self.sample_rate
+        if self.bitrate != default_bitrate:
+            options["bit_rate"] = self.bitrate
+        return options
+
+# Deepgram's default MP3, the master that other formats can be transcoded from
+DEFAULT_FORMAT = AudioFormat.of("mp3")
+
+def compute_cache_filename(text: str, model: str, fmt: AudioFormat = DEFAULT_FORMAT) -> str:
+    """Compute a SHA256 hash from text, model and output format, and return a filename for caching."""
+    if fmt == DEFAULT_FORMAT:
+        key = f"{model}:{text}"
+    else:
+        key = f"{model}:{fmt.encoding}:{fmt.sample_rate}:{fmt.bitrate}:{text}"
+    hash_object = hashlib.sha256(key.encode())
+    return hash_object.hexdigest() + "." + fmt.extension
+
+# In-flight syntheses keyed by cache filename, so concurrent identical
+# cache misses share a single Deepgram call instead of each firing their own.
+inflight_tts: dict[str, asyncio.Task] = {}
+
+# Process-wide counters, exposed via GET /stats
+stats = {
+    "tts_requests": 0,
+    "tts_synthesized": 0,
+    "tts_coalesced": 0,
+    "tts_chunk_hits": 0,
+    "tts_chunks_synthesized": 0,
+    "tts_cache_hits": 0,
+    "tts_cache_misses": 0,
+    "tts_cache_evictions": 0,
+    "tts_memory_hits": 0,
+    "tts_batch_items": 0,
+    "tts_batch_duplicates": 0,
+    "tts_shared_hits": 0,
+    "tts_shared_uploads": 0,
+    "tts_shared_evictions": 0,
+    "tts_normalization_hits": 0,
+    "tts_transcoded": 0,
+    "deepgram_throttled": 0,
+    "deepgram_queue_rejections": 0,
+    "transcribe_peak_buffered_bytes": 0,
+    "transcript_cache_hits": 0,
+    "transcript_cache_misses": 0,
+    "transcript_cache_evictions": 0,
+    "transcribe_silence_checked": 0,
+    "transcribe_silent": 0,
+    "transcribe_undecodable": 0,
+    "transcribe_bytes_saved": 0,
+}
+
+# Latency histogram buckets in seconds, for GET /metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(labels: tuple) -> str:
+    """Render (name, value) pairs as a Prometheus label set."""
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class Histogram:
+    """Cumulative histogram per label set, rendered in the Prometheus text format."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # label set -> [bucket counts..., +Inf count, sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                lines.append(f"{self.name}_bucket{format_labels((*labels, ('le', bound)))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series[-2]}")
+        return lines
+
+request_latency = Histogram("http_request_duration_seconds", "Time from request start to the last response byte.")
+upstream_latency = Histogram("upstream_request_duration_seconds", "Latency of Deepgram and Gemini calls.")
+# (upstream, operation, reason) -> count
+upstream_errors: dict[tuple, int] = {}
+upstream_inflight = {"deepgram": 0, "gemini": 0}
+http_inflight = 0
+
+@asynccontextmanager
+async def track_upstream(upstream: str, operation: str):
+    """Record the latency, errors, concurrency and trace span of one upstream call."""
+    upstream_inflight[upstream] += 1
+    start = time.perf_counter()
+    try:
+        with tracer.span(f"{upstream}.{operation}"):
+            yield
+    except Exception as e:
+        reason = str(e.status_code) if isinstance(e, UpstreamError) else type(e).__name__
+        key = (upstream, operation, reason)
+        upstream_errors[key] = upstream_errors.get(key, 0) + 1
+        raise
+    finally:
+        upstream_inflight[upstream] -= 1
+        upstream_latency.observe((("upstream", upstream), ("operation", operation)), time.perf_counter() - start)
+
+def route_template(scope, root_path: str) -> str:
+    """
+    Route template of a handled request, e.g. "/tts", or "/static/{path}" for
+    a file under a mount; "unmatched" when no route handled it. root_path is
+    scope["root_path"] from before the router ran, which mounts extend.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    mount = scope.get("root_path", "")[len(root_path):]
+    return mount + "/{path}" if mount else "unmatched"
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request until its last response byte,
+    labelled by route template rather than raw path to bound cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global http_inflight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        http_inflight += 1
+        root_path = scope.get("root_path", "")
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_inflight -= 1
+            labels = (("method", scope["method"]), ("route", route_template(scope, root_path)), ("status", str(status)))
+            request_latency.observe(labels, time.perf_counter() - start)
+
+app.add_middleware(MetricsMiddleware)
+
+# Request tracing. TRACING selects the backend:
+#   - "off" records nothing and adds no trace headers
+#   - "memory" keeps the last TRACE_MEMORY_SPANS finished spans in process, for tests and debugging
+#   - "otel" hands spans to the OpenTelemetry API (configure its SDK and exporter separately)
+TRACING = os.getenv("TRACING", "off").lower()
+TRACE_MEMORY_SPANS = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))
+# W3C trace context header: version-trace_id-parent_id-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+@dataclass
+class SpanRecord:
+    """A span with OpenTelemetry-style hex IDs and nanosecond timestamps."""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+    status: str = "OK"
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+class NullSpan:
+    def set_attribute(self, key: str, value):
+        pass
+
+class InMemorySpanExporter:
+    """Keeps the most recent finished spans, for tests and debugging."""
+
+    def __init__(self, max_spans: int):
+        self.spans: deque[SpanRecord] = deque(maxlen=max_spans)
+
+    def export(self, span: SpanRecord):
+        self.spans.append(span)
+
+    def get_finished_spans(self, trace_id: str = None) -> list[SpanRecord]:
+        return [span for span in self.spans if trace_id is None or span.trace_id == trace_id]
+
+    def clear(self):
+        self.spans.clear()
+
+class Tracer:
+    """
+    Interface of a tracing backend. span() opens a child of the current span
+    (or of the traceparent header, or a new trace) for the duration of a
+    with block; record() adds an already finished child span. This base
+    class records nothing.
+    """
+
+    @contextmanager
+    def span(self, name: str, attributes: dict = None, traceparent: str = None):
+        yield NullSpan()
+
+    def record(self, name: str, start_ns: int, end_ns: int, attributes: dict = None):
+        pass
+
+    def rename(self, span, name: str):
+        """Rename an open span, once its final name is known."""
+
+    def current_ids(self) -> tuple[str, str] | None:
+        """(trace ID, span ID) of the current span as hex, or None outside a trace."""
+        return None
+
+class LocalTracer(Tracer):
+    """Spans kept in a contextvar and passed to an exporter when they end."""
+
+    def __init__(self, exporter: InMemorySpanExporter):
+        self.exporter = exporter
+        self.current: contextvars.ContextVar[SpanRecord | None] = contextvars.ContextVar("current_span", default=None)
+
+    def child(self, name: str, start_ns: int, attributes: dict = None, traceparent: str = None) -> SpanRecord:
+        parent = self.current.get()
+        if parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        elif traceparent and (match := TRACEPARENT.match(traceparent)):
+            trace_id, parent_id = match.groups()
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+        return SpanRecord(name, trace_id, os.urandom(8).hex(), parent_id, start_ns, attributes=dict(attributes or {}))
+
+    @contextmanager
+    def span(self, name: str, attributes: dict = None, traceparent: str = None):
+        span = self.child(name, time.time_ns(), attributes, traceparent)
+        token = self.current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.status = "ERROR"
+            span.set_attribute("error.type", type(e).__name__)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self.current.reset(token)
+            self.exporter.export(span)
+
+    def record(self, name: str, start_ns: int, end_ns: int, attributes: dict = None):
+        span = self.child(name, start_ns, attributes)
+        span.end_ns = end_ns
+        self.exporter.export(span)
+
+    def rename(self, span: SpanRecord, name: str):
+        span.name = name
+
+    def current_ids(self) -> tuple[str, str] | None:
+        span = self.current.get()
+        return (span.trace_id, span.span_id) if span is not None else None
+
+class OpenTelemetryTracer(Tracer):
+    """Spans created through the OpenTelemetry API. Requires opentelemetry-api."""
+
+    def __init__(self):
+        try:
+            from opentelemetry import trace, propagate
+        except ImportError:
+            raise RuntimeError("TRACING=otel requires opentelemetry-api (pip install opentelemetry-api opentelemetry-sdk)")
+        self.trace = trace
+        self.propagate = propagate
+        self.tracer = trace.get_tracer(__name__)
+
+    @contextmanager
+    def span(self, name: str, attributes: dict = None, traceparent: str = None):
+        context = self.propagate.extract({"traceparent": traceparent}) if traceparent else None
+        with self.tracer.start_as_current_span(name, context=context, attributes=attributes) as span:
+            yield span
+
+    def record(self, name: str, start_ns: int, end_ns: int, attributes: dict = None):
+        self.tracer.start_span(name, attributes=attributes, start_time=start_ns).end(end_time=end_ns)
+
+    def rename(self, span, name: str):
+        span.update_name(name)
+
+    def current_ids(self) -> tuple[str, str] | None:
+        context = self.trace.get_current_span().get_span_context()
+        if not context.is_valid:
+            return None
+        return format(context.trace_id, "032x"), format(context.span_id, "016x")
+
+def create_tracer(backend: str) -> Tracer:
+    if backend == "otel":
+        return OpenTelemetryTracer()
+    if backend == "memory":
+        return LocalTracer(span_exporter)
+    return Tracer()
+
+span_exporter = InMemorySpanExporter(TRACE_MEMORY_SPANS)
+tracer = create_tracer(TRACING)
+
+async def run_traced(name: str, func, *args):
+    """
+    run_in_threadpool inside a span named name, with a threadpool.wait
+    child covering the time spent queued for a worker thread.
+    """
+    with tracer.span(name):
+        queued_ns = time.time_ns()
+        def call():
+            tracer.record("threadpool.wait", queued_ns, time.time_ns())
+            return func(*args)
+        return await run_in_threadpool(call)
+
+class TracingMiddleware:
+    """
+    ASGI middleware opening a root span per HTTP request (continuing an
+    incoming traceparent header) and returning its IDs in the X-Trace-Id
+    and traceparent response headers. The span is named after the method
+    and route template, like the MetricsMiddleware labels.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        traceparent = Headers(scope=scope).get("traceparent")
+        root_path = scope.get("root_path", "")
+        with tracer.span(scope["method"], {"http.method": scope["method"]}, traceparent) as span:
+            ids = tracer.current_ids()
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    if ids is not None:
+                        message["headers"] = [
+                            *message.get("headers", []),
+                            (b"x-trace-id", ids[0].encode()),
+                            (b"traceparent", f"00-{ids[0]}-{ids[1]}-01".encode()),
+                        ]
+                await send(message)
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = route_template(scope, root_path)
+                tracer.rename(span, f"{scope['method']} {route}")
+                span.set_attribute("http.route", route)
+
+app.add_middleware(TracingMiddleware)
+
+def single_flight(key: str, factory) -> asyncio.Future:
+    """
+    Return an awaitable for the in-flight task registered under key, starting
+    one from factory() if none is running. Waiters are shielded so a client
+    disconnect does not cancel the synthesis for everyone else.
+    """
+    task = inflight_tts.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        inflight_tts[key] = task
+        task.add_done_callback(lambda _: inflight_tts.pop(key, None))
+    else:
+        stats["tts_coalesced"] += 1
+    return asyncio.shield(task)
+
+# Suffix of in-progress cache files. A file only appears under its hashed
+# name once it is complete, and only then is it added to the cache index.
+TEMP_SUFFIX = ".part"
+# Temp files older than this are considered orphaned and removed by reconcile()
+TEMP_GRACE_SECONDS = int(os.getenv("TTS_TEMP_GRACE_SECONDS", "300"))
+
+def make_temp_path(file_path: str) -> str:
+    """Create an empty temp file next to file_path, and its directory if needed, and return its path."""
+    if os.path.dirname(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path) or ".",
+        prefix=os.path.basename(file_path) + ".",
+        suffix=TEMP_SUFFIX,
+    )
+    os.close(fd)
+    return tmp_path
+
+def commit_temp_file(tmp_path: str, file_path: str, fmt: AudioFormat = None):
+    """Flush tmp_path to disk, atomically rename it to file_path and add it to the cache index."""
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    # fsync the directory so the rename itself survives a crash
+    dir_fd = os.open(os.path.dirname(file_path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    tts_cache.add(os.path.basename(file_path), os.path.getsize(file_path), fmt)
+
+# Cache files are spread over two levels of directories named after the
+# first four hex digits of their hash, e.g. static/ab/cd/abcd....mp3, so no
+# single directory grows to the size of the whole cache. Files from the old
+# flat layout are still found until `python main.py migrate-cache` has moved
+# them into their shards.
+def shard_dir(filename: str) -> str:
+    return os.path.join(filename[:2], filename[2:4])
+
+def shard_path(folder: str, filename: str) -> str:
+    return os.path.join(folder, shard_dir(filename), filename)
+
+def static_path(filename: str) -> str:
+    """Path of filename under the /static mount."""
+    return f"{filename[:2]}/{filename[2:4]}/{filename}"
+
+def cache_file_candidates(folder: str, filename: str) -> tuple[str, ...]:
+    # The shard is checked again last in case a migration moved the file
+    # between the first two checks
+    return shard_path(folder, filename), os.path.join(folder, filename), shard_path(folder, filename)
+
+def find_cache_file(folder: str, filename: str) -> str | None:
+    """Path of filename in folder, in its shard or the old flat layout, or None. Blocking."""
+    for path in cache_file_candidates(folder, filename):
+        if os.path.isfile(path):
+            return path
+    return None
+
+def iter_cache_dir(folder: str):
+    """Yield a DirEntry for every file in folder and its shards, temp files included. Blocking."""
+    with os.scandir(folder) as top:
+        for entry in top:
+            if entry.is_file():
+                yield entry
+            elif len(entry.name) == 2 and entry.is_dir():
+                with os.scandir(entry.path) as shards:
+                    for shard in shards:
+                        if len(shard.name) == 2 and shard.is_dir():
+                            with os.scandir(shard.path) as files:
+                                yield from (f for f in files if f.is_file())
+
+def migrate_flat_cache(folder: str) -> tuple[int, int]:
+    """
+    Move the files of the old flat layout of folder into their shards. Safe
+    to run while the app is serving: each file is renamed atomically and is
+    found at either location meanwhile. Blocking.
+    Returns:
+        tuple: (files moved, flat duplicates of files already in their shard removed)
+    """
+    moved = duplicates = 0
+    with os.scandir(folder) as it:
+        flat = [entry.name for entry in it if entry.is_file() and not entry.name.endswith(TEMP_SUFFIX)]
+    for filename in flat:
+        source, target = os.path.join(folder, filename), shard_path(folder, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            if os.path.exists(target):
+                # Written into its shard since; same hash, same audio
+                os.remove(source)
+                duplicates += 1
+            else:
+                os.replace(source, target)
+                moved += 1
+        except FileNotFoundError:
+            pass  # evicted meanwhile
+    return moved, duplicates
+
+# Cache limits; 0 disables the corresponding limit
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", "0"))
+TTS_CACHE_MAX_AGE_SECONDS = int(os.getenv("TTS_CACHE_MAX_AGE_SECONDS", "0"))
+# "lru" evicts the least recently used files first, "lfu" the least frequently used
+TTS_CACHE_POLICY = os.getenv("TTS_CACHE_POLICY", "lru").lower()
+TTS_CACHE_SWEEP_SECONDS = int(os.getenv("TTS_CACHE_SWEEP_SECONDS", "60"))
+
+# Snapshot of the cache index, loaded at startup instead of listing the
+# cache folder, and how often the index is reconciled with the folder
+TTS_INDEX_MANIFEST = os.getenv("TTS_INDEX_MANIFEST", "tts_index.tsv")
+TTS_INDEX_RECONCILE_SECONDS = int(os.getenv("TTS_INDEX_RECONCILE_SECONDS", "300"))
+# JSONL log of the normalized text behind each cache file: appended to as
+# files are written and compacted to the indexed files whenever the index is
+# saved. Kept outside the static folder so it is never served.
+TTS_TEXT_MANIFEST = os.getenv("TTS_TEXT_MANIFEST", "tts_texts.jsonl")
+text_manifest_lock = threading.Lock()
+
+@dataclass
+class CacheEntry:
+    size: int
+    last_access: float
+    hits: int = 0
+    # Normalized text and voice model the file was synthesized from, if known
+    text: str = None
+    model: str = None
+    created: float = 0.0
+    # AudioFormat.label, or just the file extension if the format is unknown
+    format: str = None
+
+def entry_format(filename: str, fmt: AudioFormat = None) -> str:
+    return fmt.label if fmt is not None else os.path.splitext(filename)[1].lstrip(".")
+
+class TTSCache:
+    """
+    In-memory index of the cached audio files: lookups are dict hits rather
+    than filesystem stats. Tracks the size, creation and last access time,
+    hit count and format of every file, and evicts files to keep the cache
+    within its size and age limits. Methods are safe to call from the event
+    loop and from threadpool workers.
+    """
+
+    def __init__(self, folder: str, max_bytes: int, max_age: int, policy: str):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.policy = policy
+        self.entries: dict[str, CacheEntry] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.entries
+
+    def list_folder(self) -> list[str]:
+        """
+        Names of the complete files in the cache folder and its shards. Temp
+        files orphaned by syntheses interrupted by a crash or restart are
+        removed along the way. Blocking.
+        """
+        names = []
+        cutoff = time.time() - TEMP_GRACE_SECONDS
+        for entry in iter_cache_dir(self.folder):
+            if not entry.name.endswith(TEMP_SUFFIX):
+                names.append(entry.name)
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        return names
+
+    def stat_entry(self, filename: str) -> CacheEntry | None:
+        path = find_cache_file(self.folder, filename)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return CacheEntry(st.st_size, max(st.st_atime, st.st_mtime), created=st.st_mtime, format=entry_format(filename))
+
+    def replace_entries(self, entries: dict[str, CacheEntry]):
+        for filename, (model, text) in read_text_manifest().items():
+            if filename in entries:
+                entries[filename].model, entries[filename].text = model, text
+        with self.lock:
+            self.entries = entries
+            self.total_bytes = sum(e.size for e in entries.values())
+
+    def scan(self):
+        """Rebuild the index by listing and stating every file in the cache folder. Blocking."""
+        entries = {}
+        for filename in self.list_folder():
+            entry = self.stat_entry(filename)
+            if entry is not None:
+                entries[filename] = entry
+        self.replace_entries(entries)
+
+    def load(self, path: str = TTS_INDEX_MANIFEST) -> bool:
+        """Rebuild the index from the manifest. Returns False if there is none. Blocking."""
+        entries = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        filename, size, created, last_access, hits, fmt = line.rstrip("\n").split("\t")
+                        entries[filename] = CacheEntry(
+                            int(size), float(last_access), int(hits), created=float(created), format=fmt or None,
+                        )
+                    except ValueError:
+                        continue  # torn line from an interrupted write
+        except FileNotFoundError:
+            return False
+        self.replace_entries(entries)
+        return True
+
+    def snapshot(self) -> tuple[list[str], list[CacheEntry]]:
+        """
+        The indexed names and their entries, to be walked without holding the
+        lock. Two plain lists rather than (name, entry) pairs, which would
+        allocate enough to set off a full garbage collection on a large index.
+        """
+        with self.lock:
+            return list(self.entries), list(self.entries.values())
+
+    def save(self, path: str = TTS_INDEX_MANIFEST):
+        """Write the index to the manifest, atomically, and compact the text manifest to match. Blocking."""
+        names, entries = self.snapshot()
+        rows = [
+            f"{name}\t{e.size}\t{e.created:.3f}\t{e.last_access:.3f}\t{e.hits}\t{e.format or ''}\n"
+            for name, e in zip(names, entries)
+        ]
+        tmp_path = make_temp_path(path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(rows)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.save_texts()
+
+    def save_texts(self, path: str = TTS_TEXT_MANIFEST):
+        """
+        Rewrite the text manifest with only the files still in the index,
+        dropping evicted files and superseded lines. Blocking.
+        """
+        names, entries = self.snapshot()
+        rows = [text_manifest_line(name, e.model, e.text) for name, e in zip(names, entries) if e.text is not None]
+        # Held across the rewrite so no line appended meanwhile is lost
+        with text_manifest_lock:
+            tmp_path = make_temp_path(path)
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.writelines(rows)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def reconcile(self) -> tuple[int, int]:
+        """
+        Bring the index in line with the cache folder: add files written by
+        other processes or before a crash, drop entries whose files were
+        deleted behind our back, and remove orphaned temp files. Blocking.
+        Returns:
+            tuple: (entries added, entries removed)
+        """
+        started = time.time()
+        # A file being migrated may be listed twice
+        names = set(self.list_folder())
+        added = 0
+        for filename in names - self.entries.keys():
+            if self.adopt(filename):
+                added += 1
+        indexed, entries = self.snapshot()
+        # Entries added while the folder was being listed are kept
+        gone = [name for name, e in zip(indexed, entries) if name not in names and e.created < started]
+        with self.lock:
+            for name in gone:
+                entry = self.entries.get(name)
+                if entry is not None and entry.created < started:
+                    self.total_bytes -= self.entries.pop(name).size
+        for name in gone:
+            hot_audio.discard(name)
+        return added, len(gone)
+
+    def adopt(self, filename: str) -> bool:
+        """Index filename if it exists in the folder but not in the index. Returns whether it exists. Blocking."""
+        if filename in self.entries:
+            return True
+        entry = self.stat_entry(filename)
+        if entry is None:
+            return False
+        with self.lock:
+            if filename not in self.entries:
+                self.entries[filename] = entry
+                self.total_bytes += entry.size
+        return True
+
+    def add(self, filename: str, size: int, fmt: AudioFormat = None):
+        """Record a newly written cache file."""
+        hot_audio.discard(filename)
+        now = time.time()
+        with self.lock:
+            old = self.entries.get(filename)
+            if old is not None:
+                self.total_bytes -= old.size
+            self.entries[filename] = CacheEntry(size, now, created=now, format=entry_format(filename, fmt))
+            self.total_bytes += size
+
+    def set_text(self, filename: str, model: str, text: str):
+        """Record the normalized text and model a cached file was synthesized from."""
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                entry.model, entry.text = model, text
+
+    def forget(self, filename: str):
+        """Drop filename from the index, and the hot tier, after its file disappeared from disk."""
+        hot_audio.discard(filename)
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+
+    def touch(self, filename: str):
+        """Record an access to a cached file."""
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                entry.last_access = time.time()
+                entry.hits += 1
+
+    def rank(self, entry: CacheEntry) -> tuple:
+        """Eviction order of an entry under the policy: lowest first."""
+        if self.policy == "lfu":
+            return entry.hits, entry.last_access
+        return (entry.last_access,)
+
+    def ranked(self, names: list[str], count: int) -> list[tuple]:
+        """The count lowest (rank, filename) pairs among names still in the index."""
+        pairs = ((self.rank(e), name) for name in names if (e := self.entries.get(name)) is not None)
+        return heapq.nsmallest(count, pairs)
+
+    def select_victims(self) -> list[str]:
+        """
+        Remove expired and over-budget entries from the index and return their
+        filenames. Entries are ranked outside the lock, from a snapshot of
+        their names, so the event loop's touch() and add() never wait for the
+        ranking; an entry touched since it was ranked is skipped.
+        """
+        with self.lock:
+            names = list(self.entries)
+        victims = []
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            expired = [name for name in names if (e := self.entries.get(name)) is not None and e.last_access < cutoff]
+            with self.lock:
+                for name in expired:
+                    entry = self.entries.get(name)
+                    if entry is not None and entry.last_access < cutoff:
+                        self.total_bytes -= self.entries.pop(name).size
+                        victims.append(name)
+        while self.max_bytes and self.total_bytes > self.max_bytes and self.entries:
+            # Rank only about as many entries as it takes to get under budget, plus a margin
+            average = max(1, self.total_bytes // len(self.entries))
+            ranked = self.ranked(names, 2 * (self.total_bytes - self.max_bytes) // average + 16)
+            with self.lock:
+                for rank, name in ranked:
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    entry = self.entries.get(name)
+                    if entry is not None and self.rank(entry) == rank:
+                        self.total_bytes -= self.entries.pop(name).size
+                        victims.append(name)
+                names = list(self.entries)
+        return victims
+
+    def evict(self) -> int:
+        """Delete the files selected for eviction. Returns the number removed."""
+        victims = self.select_victims()
+        for name in victims:
+            hot_audio.discard(name)
+            local_storage.delete(name)
+        stats["tts_cache_evictions"] += len(victims)
+        return len(victims)
+
+tts_cache = TTSCache(audio_folder, TTS_CACHE_MAX_BYTES, TTS_CACHE_MAX_AGE_SECONDS, TTS_CACHE_POLICY)
+
+# Byte budget of the in-memory tier, and the largest clip it will hold; 0 disables it
+TTS_MEMORY_CACHE_BYTES = int(os.getenv("TTS_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+TTS_MEMORY_CACHE_MAX_ITEM_BYTES = int(os.getenv("TTS_MEMORY_CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))
+
+def file_validators(stat_result: os.stat_result) -> dict[str, str]:
+    """ETag and Last-Modified headers for a file, computed as Starlette's FileResponse does."""
+    etag_base = f"{stat_result.st_mtime}-{stat_result.st_size}"
+    return {
+        "etag": f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"',
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+
+@dataclass
+class HotClip:
+    data: bytes
+    # ETag and Last-Modified of the file the bytes were read from
+    headers: dict[str, str]
+
+class HotAudioCache:
+    """
+    Bounded LRU of recently served audio files, keyed by cache filename.
+    Entries hold immutable bytes handed to responses without copying, and
+    the validators of the file they were read from.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.items: OrderedDict[str, HotClip] = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.items
+
+    def get(self, filename: str) -> HotClip | None:
+        """Return the cached clip for filename, or None."""
+        with self.lock:
+            clip = self.items.get(filename)
+            if clip is not None:
+                self.items.move_to_end(filename)
+                stats["tts_memory_hits"] += 1
+            return clip
+
+    def put(self, filename: str, clip: HotClip):
+        """Insert clip, evicting least recently used clips to stay within budget."""
+        if len(clip.data) > min(self.max_item_bytes, self.max_bytes):
+            return
+        with self.lock:
+            old = self.items.pop(filename, None)
+            if old is not None:
+                self.total_bytes -= len(old.data)
+            self.items[filename] = clip
+            self.total_bytes += len(clip.data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.total_bytes -= len(evicted.data)
+
+    def load(self, filename: str, file_path: str):
+        """Read file_path into the cache if it fits. Blocking; run in a threadpool."""
+        if filename in self.items or os.path.getsize(file_path) > min(self.max_item_bytes, self.max_bytes):
+            return
+        with open(file_path, "rb") as f:
+            stat_result = os.fstat(f.fileno())
+            self.put(filename, HotClip(f.read(), file_validators(stat_result)))
+
+    def discard(self, filename: str):
+        """Drop filename from the cache, e.g. after the file was evicted or rewritten."""
+        with self.lock:
+            clip = self.items.pop(filename, None)
+            if clip is not None:
+                self.total_bytes -= len(clip.data)
+
+hot_audio = HotAudioCache(TTS_MEMORY_CACHE_BYTES, TTS_MEMORY_CACHE_MAX_ITEM_BYTES)
+
+def audio_media_type(filename: str) -> str:
+    """Return the Content-Type to serve a cached audio file with."""
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def read_text_manifest() -> dict[str, tuple[str, str]]:
+    """Return {filename: (model, normalized text)} from the text manifest."""
+    texts = {}
+    try:
+        with open(TTS_TEXT_MANIFEST, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    texts[record["filename"]] = (record.get("model"), record["text"])
+                except (ValueError, KeyError):
+                    continue  # torn line from an interrupted write
+    except FileNotFoundError:
+        pass
+    return texts
+
+def text_manifest_line(filename: str, model: str, text: str) -> str:
+    return json.dumps({"filename": filename, "model": model, "text": text}, ensure_ascii=False) + "\n"
+
+def append_text_manifest(filename: str, model: str, text: str):
+    with text_manifest_lock, open(TTS_TEXT_MANIFEST, "a", encoding="utf-8") as f:
+        f.write(text_manifest_line(filename, model, text))
+
+async def record_cache_text(filename: str, model: str, text: str):
+    """Record the normalized form alongside a newly written cache entry."""
+    tts_cache.set_text(filename, model, text)
+    try:
+        await run_in_threadpool(append_text_manifest, filename, model, text)
+    except OSError:
+        logger.exception("Writing the text manifest failed")
+
+async def run_cache_eviction():
+    """Periodically enforce the cache limits without blocking the event loop."""
+    while True:
+        await asyncio.sleep(TTS_CACHE_SWEEP_SECONDS)
+        try:
+            await run_in_threadpool(tts_cache.evict)
+        except Exception:
+            logger.exception("TTS cache eviction failed")
+        try:
+            await run_in_threadpool(evict_shared)
+        except Exception:
+            logger.exception("Shared cache eviction failed")
+        try:
+            await run_in_threadpool(transcript_cache.evict)
+        except Exception:
+            logger.exception("Transcript cache eviction failed")
+
+async def run_index_reconcile():
+    """Reconcile the cache index with the folder right away and then periodically, saving the manifest each time."""
+    while True:
+        try:
+            added, removed = await run_in_threadpool(tts_cache.reconcile)
+            if added or removed:
+                logger.info("Cache index reconciled: %d files added, %d removed", added, removed)
+            await run_in_threadpool(tts_cache.save)
+        except Exception:
+            logger.exception("Reconciling the TTS cache index failed")
+        await asyncio.sleep(TTS_INDEX_RECONCILE_SECONDS)
+
+class CacheStorage(ABC):
+    """
+    Interface of a store holding cached audio files by cache filename.
+    Methods are blocking and are called from threadpool workers.
+    """
+
+    @abstractmethod
+    def exists(self, filename: str) -> bool:
+        ...
+
+    @abstractmethod
+    def download(self, filename: str, local_path: str) -> bool:
+        """Copy filename to local_path. Returns False if it is not in the store."""
+
+    @abstractmethod
+    def upload(self, local_path: str, filename: str):
+        ...
+
+    @abstractmethod
+    def delete(self, filename: str):
+        """Remove filename from the store. Does nothing if it is not there."""
+
+    @abstractmethod
+    def stored_before(self, cutoff: float) -> list[str]:
+        """Filenames of the files written to the store before the cutoff timestamp."""
+
+class LocalDiskStorage(CacheStorage):
+    """
+    Audio files in a sharded directory: the local static/ cache, or a
+    directory shared between replicas. Files are written to their shard and
+    also read from the old flat layout.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, filename: str) -> str:
+        """Where filename is written."""
+        return shard_path(self.folder, filename)
+
+    def locate(self, filename: str) -> str:
+        """Where filename can be read from, which is path() unless it has not been migrated yet."""
+        return find_cache_file(self.folder, filename) or self.path(filename)
+
+    def exists(self, filename: str) -> bool:
+        return find_cache_file(self.folder, filename) is not None
+
+    def download(self, filename: str, local_path: str) -> bool:
+        try:
+            shutil.copyfile(self.locate(filename), local_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def upload(self, local_path: str, filename: str):
+        # Copy under a temp name and rename, so other replicas never see a partial file
+        tmp_path = make_temp_path(self.path(filename))
+        try:
+            shutil.copyfile(local_path, tmp_path)
+            os.replace(tmp_path, self.path(filename))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, filename: str):
+        for path in cache_file_candidates(self.folder, filename)[:2]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stored_before(self, cutoff: float) -> list[str]:
+        names = []
+        for entry in iter_cache_dir(self.folder):
+            if entry.name.endswith(TEMP_SUFFIX):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    names.append(entry.name)
+            except FileNotFoundError:
+                pass
+        return names
+
+class S3Storage(CacheStorage):
+    """Audio files in an S3-compatible bucket (AWS S3, MinIO, ...). Requires boto3."""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("S3 cache storage requires boto3 (pip install boto3)")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def key(self, filename: str) -> str:
+        return f"{self.prefix}/{filename}" if self.prefix else filename
+
+    def is_not_found(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def exists(self, filename: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(filename))
+        except self.client_error as e:
+            if self.is_not_found(e):
+                return False
+            raise
+        return True
+
+    def download(self, filename: str, local_path: str) -> bool:
+        try:
+            self.client.download_file(self.bucket, self.key(filename), local_path)
+        except self.client_error as e:
+            if self.is_not_found(e):
+                return False
+            raise
+        return True
+
+    def upload(self, local_path: str, filename: str):
+        extra_args = {"ContentType": audio_media_type(filename)}
+        self.client.upload_file(local_path, self.bucket, self.key(filename), ExtraArgs=extra_args)
+
+    def delete(self, filename: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(filename))
+
+    def stored_before(self, cutoff: float) -> list[str]:
+        names = []
+        prefix = f"{self.prefix}/" if self.prefix else ""
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["LastModified"].timestamp() < cutoff:
+                    names.append(obj["Key"][len(prefix):])
+        return names
+
+def create_shared_storage(url: str):
+    """
+    Build the shared store from TTS_SHARED_STORE:
+      - "" disables sharing
+      - "s3://bucket/prefix" uses an S3-compatible bucket (endpoint from TTS_S3_ENDPOINT_URL)
+      - anything else is a directory path shared between replicas
+    """
+    if not url:
+        return None
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Storage(bucket, prefix, os.getenv("TTS_S3_ENDPOINT_URL") or None)
+    return LocalDiskStorage(url)
+
+# The local cache served by /static, and an optional store shared by all replicas
+local_storage = LocalDiskStorage(audio_folder)
+shared_storage = create_shared_storage(os.getenv("TTS_SHARED_STORE", ""))
+# Files are deleted from the shared store this long after they were uploaded; 0 keeps them forever.
+# Every replica sweeps it, so replicas can share the cost of a large store.
+TTS_SHARED_STORE_MAX_AGE_SECONDS = int(os.getenv("TTS_SHARED_STORE_MAX_AGE_SECONDS", "0"))
+
+def evict_shared() -> int:
+    """Delete the files older than TTS_SHARED_STORE_MAX_AGE_SECONDS from the shared store. Returns the number removed."""
+    if shared_storage is None or not TTS_SHARED_STORE_MAX_AGE_SECONDS:
+        return 0
+    victims = shared_storage.stored_before(time.time() - TTS_SHARED_STORE_MAX_AGE_SECONDS)
+    for name in victims:
+        shared_storage.delete(name)
+    stats["tts_shared_evictions"] += len(victims)
+    return len(victims)
+
+def pull_from_shared(filename: str) -> bool:
+    """Copy filename from the shared store into the local cache. Returns False if it is not there."""
+    file_path = local_storage.path(filename)
+    tmp_path = make_temp_path(file_path)
+    try:
+        if not shared_storage.download(filename, tmp_path):
+            return False
+        commit_temp_file(tmp_path, file_path)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+async def cache_lookup(filename: str) -> bool:
+    """
+    Return True if filename is cached. On a local miss the shared store is
+    checked and a hit there is copied into the local cache.
+    """
+    # Answered from memory: the hot tier, then the cache index
+    if filename in hot_audio or filename in tts_cache:
+        return True
+    if shared_storage is None:
+        return False
+    try:
+        found = await run_traced("tts.shared_lookup", pull_from_shared, filename)
+    except Exception:
+        logger.exception("Shared cache lookup failed for %s", filename)
+        return False
+    if found:
+        stats["tts_shared_hits"] += 1
+    return found
+
+def locate_hit(filename: str) -> str | None:
+    """
+    Path of an indexed file, or None if it has disappeared from disk (deleted
+    by another worker's eviction or by hand), in which case it is dropped
+    from the index so the caller can treat it as a miss. Blocking.
+    """
+    path = find_cache_file(local_storage.folder, filename)
+    if path is None:
+        tts_cache.forget(filename)
+    return path
+
+def load_hit(filename: str) -> str | None:
+    """Like locate_hit, and also promote the file to the hot tier. Blocking."""
+    path = locate_hit(filename)
+    if path is None:
+        return None
+    try:
+        hot_audio.load(filename, path)
+    except FileNotFoundError:
+        tts_cache.forget(filename)
+        return None
+    return path
+
+async def publish_to_shared(file_path: str):
+    """Upload a newly written cache file to the shared store. Failures are only logged."""
+    if shared_storage is None:
+        return
+    filename = os.path.basename(file_path)
+    try:
+        # Another replica may have synthesized and published it already
+        if await run_traced("tts.shared_exists", shared_storage.exists, filename):
+            return
+        await run_traced("tts.shared_upload", shared_storage.upload, file_path, filename)
+        stats["tts_shared_uploads"] += 1
+    except Exception:
+        logger.exception("Uploading %s to the shared cache failed", file_path)
+
+async def generate_and_save_tts(text: str, model: str, file_path: str, fmt: AudioFormat = DEFAULT_FORMAT):
+    """
+    Generate TTS audio from text using Deepgram and save it to file_path.
+    The audio is streamed into a temp file in the same directory and only
+    renamed to file_path once it is complete and flushed to disk. The
+    Deepgram request waits for a slot from deepgram_limiter.
+    """
+    response, slot = await request_speech(text, model, fmt)
+    async for _ in relay_and_cache(response, file_path, model, text, fmt, slot):
+        pass
+
+# Multi-sentence texts are split into sentences that are synthesized
+# concurrently, cached individually and stitched into one MP3.
+TTS_CHUNKING = env_flag("TTS_CHUNKING", True)
+TTS_CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "4"))
+chunk_semaphore = asyncio.Semaphore(TTS_CHUNK_CONCURRENCY)
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+# Words ending in a period that do not end the sentence, e.g. "Dr. Smith" or "No. 5"
+ABBREVIATIONS = frozenset({
+    "mr", "mrs", "ms", "dr", "prof", "rev", "sr", "jr", "st", "mt", "no", "nos", "vs",
+    "inc", "ltd", "co", "corp", "dept", "fig", "vol", "ch", "pp", "approx", "ca", "cf",
+})
+# Initials and dotted abbreviations: "J.", "e.g.", "i.e.", "U.S."
+INITIALISM = re.compile(r"(?:[A-Za-z]\.)+")
+
+def ends_with_abbreviation(sentence: str) -> bool:
+    word = sentence.rsplit(None, 1)[-1].lstrip("\"'([")
+    return word[:-1].lower() in ABBREVIATIONS or INITIALISM.fullmatch(word) is not None
+
+def split_sentences(text: str) -> list[str]:
+    """
+    Split text on sentence-ending punctuation followed by whitespace, except
+    after an abbreviation or initial, or before a lowercase word or a number,
+    where the period is taken not to end the sentence.
+    """
+    sentences = []
+    for piece in SENTENCE_BOUNDARY.split(text.strip()):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if sentences and (ends_with_abbreviation(sentences[-1]) or piece[0].islower() or piece[0].isdigit()):
+            sentences[-1] += " " + piece
+        else:
+            sentences.append(piece)
+    return sentences
+
+# MPEG Layer III bitrates (kbps) and sample rates, indexed by header fields
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    0b11: (1, [44100, 48000, 32000]),  # MPEG-1
+    0b10: (2, [22050, 24000, 16000]),  # MPEG-2
+    0b00: (2, [11025, 12000, 8000]),   # MPEG-2.5
+}
+
+def mp3_frame_length(data: bytes, pos: int):
+    """Return the length of the Layer III frame starting at pos, or None if there is no valid header."""
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (data[pos + 1] >> 3) & 0b11
+    layer_bits = (data[pos + 1] >> 1) & 0b11
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 0b11
+    padding = (data[pos + 2] >> 1) & 0b1
+    if version_bits not in MP3_SAMPLE_RATES or layer_bits != 0b01:
+        return None
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    version, sample_rates = MP3_SAMPLE_RATES[version_bits]
+    bitrate = MP3_BITRATES[version][bitrate_index] * 1000
+    samples_factor = 144 if version == 1 else 72
+    return samples_factor * bitrate // sample_rates[rate_index] + padding
+
+def mp3_frames(data: bytes) -> bytes:
+    """
+    Return only the complete MPEG audio frames of an MP3 file, dropping ID3
+    tags, any Xing/Info/VBRI header frame and a truncated trailing frame, so
+    the result can be concatenated with other files frame-accurately.
+    """
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+    frames = []
+    first = True
+    while pos < len(data):
+        length = mp3_frame_length(data, pos)
+        if length is None:
+            if data[pos:pos + 3] == b"TAG":
+                break  # ID3v1 trailer
+            pos += 1  # resync on the next frame header
+            continue
+        if pos + length > len(data):
+            break
+        frame = data[pos:pos + length]
+        # The first frame may be a VBR header describing only this file
+        if not (first and (b"Xing" in frame[:64] or b"Info" in frame[:64] or frame[36:40] == b"VBRI")):
+            frames.append(frame)
+        first = False
+        pos += length
+    return b"".join(frames)
+
+def stitch_mp3_files(chunk_paths: list[str], file_path: str):
+    """Concatenate the audio frames of chunk_paths into file_path, atomically."""
+    tmp_path = make_temp_path(file_path)
+    try:
+        with open(tmp_path, "wb") as out:
+            for chunk_path in chunk_paths:
+                with open(chunk_path, "rb") as f:
+                    out.write(mp3_frames(f.read()))
+        commit_temp_file(tmp_path, file_path, DEFAULT_FORMAT)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+async def synthesize_chunk(sentence: str, model: str) -> str:
+    """Return the cached file for a single sentence, synthesizing it if needed."""
+    filename = compute_cache_filename(sentence, model)
+    chunk_path = local_storage.path(filename)
+    if await cache_lookup(filename):
+        path = await run_in_threadpool(locate_hit, filename)
+        if path is not None:
+            stats["tts_chunk_hits"] += 1
+            tts_cache.touch(filename)
+            return path
+
+    async def synthesize():
+        if await run_in_threadpool(tts_cache.adopt, filename):
+            return
+        async with chunk_semaphore:
+            await generate_and_save_tts(sentence, model, chunk_path)
+        stats["tts_chunks_synthesized"] += 1
+
+    await single_flight(filename, synthesize)
+    return await run_in_threadpool(local_storage.locate, filename)
+
+# Other formats are transcoded locally from a cached DEFAULT_FORMAT master when
+# that loses nothing: lossy and telephony encodings at no higher a sample rate
+# or bitrate than the master. Lossless and higher-rate formats are always
+# synthesized. Encodings soundfile can write, as (container, subtype):
+TTS_TRANSCODE = env_flag("TTS_TRANSCODE", True)
+TRANSCODE_TARGETS = {
+    "mulaw": ("WAV", "ULAW"),
+    "alaw": ("WAV", "ALAW"),
+    "mp3": ("MP3", "MPEG_LAYER_III"),
+}
+
+def can_transcode(fmt: AudioFormat) -> bool:
+    """Whether fmt can be transcoded from the master without being better than it."""
+    return (
+        fmt.encoding in TRANSCODE_TARGETS
+        and fmt.sample_rate <= DEFAULT_FORMAT.sample_rate
+        and (fmt.bitrate or 0) <= DEFAULT_FORMAT.bitrate
+    )
+
+def compression_level(fmt: AudioFormat) -> float | None:
+    """
+    libsndfile compression level giving roughly fmt.bitrate: the level maps
+    linearly from the highest (0.0) to the lowest (1.0) bitrate of the codec.
+    """
+    if fmt.bitrate is None:
+        return None
+    if fmt.encoding == "opus":
+        lowest, highest = 6000, 256000
+    elif fmt.sample_rate >= 32000:
+        lowest, highest = 32000, 320000  # MPEG-1
+    elif fmt.sample_rate >= 16000:
+        lowest, highest = 8000, 160000  # MPEG-2
+    else:
+        lowest, highest = 8000, 64000  # MPEG-2.5
+    return min(1.0, max(0.0, (highest - fmt.bitrate) / (highest - lowest)))
+
+def transcode_file(master_path: str, file_path: str, fmt: AudioFormat):
+    """Decode master_path, resample it to mono at fmt.sample_rate and write it to file_path as fmt, atomically."""
+    container, subtype = TRANSCODE_TARGETS[fmt.encoding]
+    samples, rate = sf.read(master_path, dtype="float32", always_2d=True)
+    samples = resample(samples.mean(axis=1), rate, fmt.sample_rate)
+    tmp_path = make_temp_path(file_path)
+    try:
+        sf.write(
+            tmp_path, samples, fmt.sample_rate, format=container, subtype=subtype,
+            compression_level=compression_level(fmt),
+            bitrate_mode="CONSTANT" if fmt.encoding == "mp3" and fmt.bitrate else None,
+        )
+        commit_temp_file(tmp_path, file_path, fmt)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+async def transcode_from_master(text: str, model: str, file_path: str, fmt: AudioFormat) -> bool:
+    """
+    Produce file_path by transcoding the cached master of text+model. Returns
+    False, so Deepgram synthesizes the file instead, when there is no master,
+    fmt needs better quality than the master (see can_transcode), or
+    transcoding fails.
+    """
+    if not TTS_TRANSCODE or not can_transcode(fmt):
+        return False
+    master = compute_cache_filename(text, model)
+    if not await cache_lookup(master):
+        return False
+    master_path = await run_in_threadpool(locate_hit, master)
+    if master_path is None:
+        return False
+    try:
+        await run_traced("tts.transcode", transcode_file, master_path, file_path, fmt)
+    except Exception:
+        logger.exception("Transcoding %s to %s failed", master, fmt)
+        return False
+    tts_cache.touch(master)
+    stats["tts_transcoded"] += 1
+    await publish_to_shared(file_path)
+    await record_cache_text(os.path.basename(file_path), model, text)
+    return True
+
+def transcode_once(text: str, model: str, file_path: str, fmt: AudioFormat) -> asyncio.Future:
+    """
+    transcode_from_master, shared by concurrent callers. Registered under its
+    own single-flight key: callers joining it get its bool result, never the
+    result of a synthesis registered under the cache filename.
+    """
+    key = "transcode:" + os.path.basename(file_path)
+    return single_flight(key, lambda: transcode_from_master(text, model, file_path, fmt))
+
+async def synthesize_to_cache(text: str, model: str, file_path: str, fmt: AudioFormat = DEFAULT_FORMAT):
+    """
+    Synthesize text into file_path unless the file has appeared meanwhile.
+    Formats other than the default are transcoded from a cached master when
+    there is one. Multi-sentence texts in the default format are synthesized
+    sentence by sentence in parallel and stitched together; anything else is
+    synthesized in a single call.
+    """
+    # Already on disk but not indexed yet (e.g. written before a crash)
+    if await run_in_threadpool(tts_cache.adopt, os.path.basename(file_path)):
+        return
+    if fmt != DEFAULT_FORMAT and await transcode_once(text, model, file_path, fmt):
+        return
+    sentences = split_sentences(text) if TTS_CHUNKING and fmt == DEFAULT_FORMAT else []
+    with tracer.span("tts.synthesize", {"sentences": max(1, len(sentences)), "encoding": fmt.encoding}):
+        if len(sentences) > 1:
+            chunk_paths = await asyncio.gather(*(synthesize_chunk(s, model) for s in sentences))
+            await run_traced("tts.stitch", stitch_mp3_files, chunk_paths, file_path)
+            await publish_to_shared(file_path)
+            await record_cache_text(os.path.basename(file_path), model, text)
+        else:
+            await generate_and_save_tts(text, model, file_path, fmt)
+    stats["tts_synthesized"] += 1
+
+# Cache keys the raw, un-normalized texts of recent requests would have had,
+# to tell which hits only happened because of normalization
+TTS_RAW_KEYS_TRACKED = 100_000
+raw_keys_seen: OrderedDict[str, None] = OrderedDict()
+
+def raw_key_is_new(raw_text: str, text: str, model: str, fmt: AudioFormat) -> bool:
+    """
+    Whether keying by raw_text would miss: it differs from its normalized
+    form text and was never requested before. Remembers it either way.
+    """
+    if raw_text == text:
+        return False
+    key = compute_cache_filename(raw_text, model, fmt)
+    seen = key in raw_keys_seen
+    raw_keys_seen[key] = None
+    raw_keys_seen.move_to_end(key)
+    while len(raw_keys_seen) > TTS_RAW_KEYS_TRACKED:
+        raw_keys_seen.popitem(last=False)
+    return not seen
+
+def count_cache_hit(filename: str, raw_key_new: bool):
+    """Record a cache hit, and whether only normalization produced it (see raw_key_is_new)."""
+    stats["tts_cache_hits"] += 1
+    if raw_key_new:
+        stats["tts_normalization_hits"] += 1
+    tts_cache.touch(filename)
+
+async def ensure_cached(text: str, model: str, limiter=None, fmt: AudioFormat = DEFAULT_FORMAT) -> tuple[str, bool]:
+    """
+    Make sure the audio for the normalized text+model in format fmt is in the cache.
+    A miss joins an in-flight synthesis for the same file or starts one,
+    holding limiter (if given) while it waits.
+    Returns:
+        tuple: (cache filename, whether it was already cached)
+    """
+    # Compute cache filename based on the normalized text and model
+    with tracer.span("tts.cache_key"):
+        raw_text, text = text, normalize_text(text)
+        filename = compute_cache_filename(text, model, fmt)
+        raw_key_new = raw_key_is_new(raw_text, text, model, fmt)
+    file_path = local_storage.path(filename)
+    stats["tts_requests"] += 1
+
+    # Check if the file already exists (cache hit). The index is trusted: a
+    # file deleted behind its back is dropped on the /static 404 or by reconcile()
+    with tracer.span("tts.cache_lookup") as span:
+        cached = await cache_lookup(filename)
+        span.set_attribute("cache.hit", cached)
+    if cached:
+        count_cache_hit(filename, raw_key_new)
+        return filename, True
+    stats["tts_cache_misses"] += 1
+
+    async with limiter or nullcontext():
+        await single_flight(filename, lambda: synthesize_to_cache(text, model, file_path, fmt))
+    return filename, False
+
 @app.post("/tts", response_class=JSONResponse)
 async def text_to_speech(req: TTSRequest, request: Request):
     """
     Accepts a JSON payload with:
       - "text": The text to convert to speech.
       - "model": (Optional) The voice model to use (default: "aura-2-thalia-en").
+      - "encoding", "sample_rate", "bitrate": (Optional) Output format (default: Deepgram's MP3).
       
     Implements a caching mechanism:
-      - A unique filename is generated based on the hash of text+model.
+      - A unique filename is generated based on the hash of text+model+format.
       - If the file already exists, the cached version is returned.
       - Otherwise, the service generates the TTS audio, saves it, and returns the link.
     """
     try:
-        # Compute cache filename based on text and model
-        filename = compute_cache_filename(req.text, req.model)
-        file_path = os.path.join(audio_folder, filename)
+        # Make sure the audio is cached, synthesizing it on a miss
+        filename, cached = await ensure_cached(req.text, req.model, fmt=req.audio_format())
 
         # Build the absolute URL for the static file
         # Using url_for to respect mount settings and host
-        file_url = request.url_for('static', path=filename)
+        file_url = request.url_for('static', path=static_path(filename))
+
+        # Return the link to the cached or newly saved audio file
+        return {"link": str(file_url), "cached": cached}
+    except Exception as e:
+        raise synthesis_error(e)
+
+# Maximum number of concurrent syntheses per /tts/batch call
+TTS_BATCH_CONCURRENCY = int(os.getenv("TTS_BATCH_CONCURRENCY", "8"))
+
+async def batch_results(reqs: list[TTSRequest], groups: dict[str, list[int]], request: Request):
+    """
+    Yield one NDJSON line per batch item as its cache filename becomes available.
+    Cache hits complete immediately; misses are synthesized with at most
+    TTS_BATCH_CONCURRENCY in flight.
+    """
+    limiter = asyncio.Semaphore(TTS_BATCH_CONCURRENCY)
+    # Copied into the tasks below, so their Deepgram requests queue behind live traffic
+    synthesis_priority.set(PRIORITY_BATCH)
+
+    async def process(indices: list[int]):
+        req = reqs[indices[0]]
+        try:
+            filename, cached = await ensure_cached(req.text, req.model, limiter, req.audio_format())
+            link = str(request.url_for('static', path=static_path(filename)))
+            return indices, {"status": "ok", "link": link, "cached": cached}
+        except Exception as e:
+            return indices, {"status": "error", "detail": str(e)}
+
+    tasks = [asyncio.create_task(process(indices)) for indices in groups.values()]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indices, result = await next_done
+            for index in indices:
+                yield json.dumps({"index": index, **result}) + "\n"
+    finally:
+        # Client went away: stop waiting (in-flight syntheses still complete)
+        for task in tasks:
+            task.cancel()
+
+@app.post("/tts/batch")
+async def text_to_speech_batch(reqs: list[TTSRequest], request: Request):
+    """
+    Accepts a JSON array of /tts payloads and streams back NDJSON, one line
+    per item in completion order:
+      - {"index": 0, "status": "ok", "link": "...", "cached": true}
+      - {"index": 1, "status": "error", "detail": "..."}
+
+    Items with the same text and model are synthesized once and share a result.
+    """
+    groups: dict[str, list[int]] = {}
+    for index, req in enumerate(reqs):
+        groups.setdefault(compute_cache_filename(normalize_text(req.text), req.model, req.audio_format()), []).append(index)
+    stats["tts_batch_items"] += len(reqs)
+    stats["tts_batch_duplicates"] += len(reqs) - len(groups)
+    return StreamingResponse(batch_results(reqs, groups, request), media_type="application/x-ndjson")
+
+async def relay_and_cache(response, file_path: str, model: str, text: str, fmt: AudioFormat = DEFAULT_FORMAT,
+                          slot: LimiterSlot = None):
+    """
+    Yield audio chunks from a streaming Deepgram response while teeing them
+    into a temp file, which is committed to file_path once the stream ends.
+    If the stream is interrupted the partial file is discarded. The limiter
+    slot of the request, if given, is released once the response is closed.
+    """
+    tmp_path = make_temp_path(file_path)
+    try:
+        # Spans cannot stay open across yields, so the relay is recorded once it ends
+        relay_start = time.time_ns()
+        write_ns = 0
+        written = 0
+        with open(tmp_path, "wb") as out:
+            async for chunk in response.aiter_bytes():
+                write_start = time.perf_counter_ns()
+                out.write(chunk)
+                write_ns += time.perf_counter_ns() - write_start
+                written += len(chunk)
+                yield chunk
+        tracer.record("deepgram.relay", relay_start, time.time_ns(), {"bytes": written, "file.write_seconds": write_ns / 1e9})
+        await run_traced("tts.file_commit", commit_temp_file, tmp_path, file_path, fmt)
+        await publish_to_shared(file_path)
+        await record_cache_text(os.path.basename(file_path), model, text)
+    finally:
+        await response.aclose()
+        if slot is not None:
+            slot.release()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class StreamRelay:
+    """
+    A /tts/stream synthesis shared by every request for the same file. A
+    background task relays the Deepgram response into the cache file and
+    keeps the chunks received so far, so requests joining late still get
+    the audio from the start. Chunks are only held while the relay runs.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.done = False
+        self.error: BaseException | None = None
+        # Resolved once Deepgram accepted the request, or failed with its error
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.started.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def append(self, chunk: bytes):
+        self.chunks.append(chunk)
+        self.notify()
+
+    def finish(self, error: BaseException = None):
+        self.done, self.error = True, error
+        if not self.started.done():
+            if error is not None:
+                self.started.set_exception(error)
+            else:
+                self.started.set_result(None)
+        self.notify()
+
+    async def subscribe(self):
+        """Yield every chunk of the relay from the start, raising if it fails midway."""
+        index = 0
+        while True:
+            changed = self.changed
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+# /tts/stream syntheses in progress, by cache filename; each is also in inflight_tts
+stream_relays: dict[str, StreamRelay] = {}
 
-        # Check if the file already exists (cache hit)
-        if os.path.exists(file_path):
-            return {"link": str(file_url), "cached": True}
+def start_stream_relay(text: str, model: str, file_path: str, fmt: AudioFormat) -> StreamRelay:
+    """
+    Start synthesizing file_path for /tts/stream, registered under its cache
+    filename in inflight_tts, so /tts waits for it, and in stream_relays, so
+    other /tts/stream requests stream from it instead of calling Deepgram.
+    """
+    filename = os.path.basename(file_path)
+    relay = StreamRelay()
+
+    async def run():
+        try:
+            response, slot = await request_speech(text, model, fmt)
+            relay.started.set_result(None)
+            stats["tts_synthesized"] += 1
+            async for chunk in relay_and_cache(response, file_path, model, text, fmt, slot):
+                relay.append(chunk)
+        except BaseException as e:
+            relay.finish(e)
+            raise
+        relay.finish()
+
+    def unregister(task: asyncio.Task):
+        inflight_tts.pop(filename, None)
+        stream_relays.pop(filename, None)
+        # Failures reach the requests through the relay
+        task.cancelled() or task.exception()
+
+    task = asyncio.ensure_future(run())
+    inflight_tts[filename] = task
+    stream_relays[filename] = relay
+    task.add_done_callback(unregister)
+    return relay
+
+@app.post("/tts/stream")
+async def text_to_speech_stream(req: TTSRequest):
+    """
+    Accepts the same JSON payload as /tts, but returns the audio itself
+    as a chunked response instead of a link.
 
-        # Run the blocking TTS operation in a threadpool (cache miss)
-        await run_in_threadpool(generate_and_save_tts, req.text, req.model, file_path)
+      - On a cache hit, the cached file is streamed straight from disk.
+      - For formats other than the default, a cached master is transcoded.
+      - Otherwise, audio chunks are relayed to the client as they arrive from
+        Deepgram and written to the same hashed cache file along the way.
+        Concurrent requests for the same file stream from that one relay,
+        and /tts waits for it.
 
-        # Return the link to the newly saved audio file
-        return {"link": str(file_url), "cached": False}
+    The X-Cache response header is "HIT", "TRANSCODED" or "MISS".
+    """
+    fmt = req.audio_format()
+    with tracer.span("tts.cache_key"):
+        text = normalize_text(req.text)
+        filename = compute_cache_filename(text, req.model, fmt)
+        raw_key_new = raw_key_is_new(req.text, text, req.model, fmt)
+    file_path = local_storage.path(filename)
+    stats["tts_requests"] += 1
+
+    # If another request is already synthesizing this file, join it rather than paying twice
+    relay = stream_relays.get(filename)
+    if relay is not None:
+        return await join_stream_relay(relay, fmt)
+    inflight = inflight_tts.get(filename)
+    if inflight is not None:
+        stats["tts_coalesced"] += 1
+        try:
+            await asyncio.shield(inflight)
+        except Exception as e:
+            raise synthesis_error(e)
+
+    with tracer.span("tts.cache_lookup") as span:
+        clip = hot_audio.get(filename)
+        cached = clip is not None or await cache_lookup(filename)
+        span.set_attribute("cache.hit", cached)
+    if clip is not None:
+        count_cache_hit(filename, raw_key_new)
+        return Response(clip.data, media_type=fmt.media_type, headers={"X-Cache": "HIT"})
+    if cached:
+        hit_path = await run_traced("tts.memory_load", load_hit, filename)
+        if hit_path is not None:
+            count_cache_hit(filename, raw_key_new)
+            return FileResponse(hit_path, media_type=fmt.media_type, headers={"X-Cache": "HIT"})
+    stats["tts_cache_misses"] += 1
+
+    if fmt != DEFAULT_FORMAT:
+        try:
+            transcoded = await transcode_once(text, req.model, file_path, fmt)
+        except Exception as e:
+            raise synthesis_error(e)
+        if transcoded:
+            return FileResponse(file_path, media_type=fmt.media_type, headers={"X-Cache": "TRANSCODED"})
+
+    # Checked again: a synthesis may have started while the cache was being looked up
+    relay = stream_relays.get(filename)
+    if relay is not None:
+        return await join_stream_relay(relay, fmt)
+    if filename in inflight_tts:
+        stats["tts_coalesced"] += 1
+        try:
+            await asyncio.shield(inflight_tts[filename])
+        except Exception as e:
+            raise synthesis_error(e)
+        file_path = await run_in_threadpool(local_storage.locate, filename)
+        return FileResponse(file_path, media_type=fmt.media_type, headers={"X-Cache": "HIT"})
+    return await join_stream_relay(start_stream_relay(text, req.model, file_path, fmt), fmt, coalesced=False)
+
+async def join_stream_relay(relay: StreamRelay, fmt: AudioFormat, coalesced: bool = True) -> StreamingResponse:
+    """Stream a relay once Deepgram has accepted its request, or fail like the synthesis did."""
+    if coalesced:
+        stats["tts_coalesced"] += 1
+    try:
+        await asyncio.shield(relay.started)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise synthesis_error(e)
+    return StreamingResponse(relay.subscribe(), media_type=fmt.media_type, headers={"X-Cache": "MISS"})
+
+@app.get("/stats")
+async def get_stats():
+    """Return the process-wide service counters."""
+    return {
+        **stats,
+        "tts_inflight": len(inflight_tts),
+        "tts_cache_files": len(tts_cache.entries),
+        "tts_cache_bytes": tts_cache.total_bytes,
+        "tts_memory_files": len(hot_audio.items),
+        "tts_memory_bytes": hot_audio.total_bytes,
+    }
+
+# Counters in stats that are high-water marks rather than running totals.
+# Every other stat is exported as a Prometheus counter and must never decrease.
+GAUGE_STATS = {"transcribe_peak_buffered_bytes"}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Return request, upstream, cache and threadpool metrics in the Prometheus text format."""
+    def gauge(name: str, help_text: str, values: dict):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge"])
+        lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in values.items())
+
+    lines = request_latency.render() + upstream_latency.render()
+    lines.extend(["# HELP upstream_errors_total Failed Deepgram and Gemini calls.", "# TYPE upstream_errors_total counter"])
+    for (upstream, operation, reason), count in sorted(upstream_errors.items()):
+        labels = (("upstream", upstream), ("operation", operation), ("reason", reason))
+        lines.append(f"upstream_errors_total{format_labels(labels)} {count}")
+    for name, value in stats.items():
+        if name in GAUGE_STATS:
+            gauge(name, name.replace("_", " ").capitalize() + ".", {(): value})
+        else:
+            lines.extend([f"# TYPE {name}_total counter", f"{name}_total {value}"])
+
+    gauge("http_requests_in_flight", "Requests being served.", {(): http_inflight})
+    gauge("upstream_requests_in_flight", "Deepgram and Gemini calls in progress.",
+          {(("upstream", upstream),): count for upstream, count in upstream_inflight.items()})
+    gauge("tts_syntheses_in_flight", "Distinct syntheses in progress.", {(): len(inflight_tts)})
+    gauge("deepgram_concurrency_limit", "Current adaptive limit on Deepgram requests in flight.",
+          {(): int(deepgram_limiter.limit)})
+    gauge("deepgram_queue_depth", "Deepgram requests waiting for the limiter.", {(): len(deepgram_limiter.waiters)})
+    gauge("tts_cache_files", "Audio files in the disk cache.", {(): len(tts_cache.entries)})
+    gauge("tts_cache_bytes", "Bytes of audio in the disk cache.", {(): tts_cache.total_bytes})
+    gauge("tts_memory_bytes", "Bytes of audio in the in-memory hot tier.", {(): hot_audio.total_bytes})
+    # run_in_threadpool borrows a token from the default anyio limiter
+    threadpool = anyio.to_thread.current_default_thread_limiter().statistics()
+    gauge("threadpool_threads_busy", "Worker threads running blocking calls.", {(): threadpool.borrowed_tokens})
+    gauge("threadpool_threads_max", "Worker thread limit.", {(): threadpool.total_tokens})
+    gauge("threadpool_queue_depth", "Blocking calls waiting for a worker thread.", {(): threadpool.tasks_waiting})
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Catalog pre-warming synthesizes known prompts into the cache ahead of traffic,
+# from the CLI (python main.py prewarm CATALOG) or the /admin/prewarm endpoints.
+# A run can be interrupted and restarted at any time: entries already in the
+# cache are skipped, and partially written files never appear under their
+# cache name.
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "4"))
+# Errors kept per job report, and finished jobs kept for GET /admin/prewarm/{id}
+PREWARM_MAX_ERRORS = 100
+PREWARM_MAX_JOBS = 16
+# Bearer token required by the /admin endpoints; they are disabled when unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def read_catalog(stream, kind: str) -> tuple[list[tuple[int, TTSRequest]], list[dict]]:
+    """
+    Parse a catalog of /tts request bodies, either "csv" (a header row with a
+    text column and optional model, encoding, sample_rate and bitrate columns)
+    or "jsonl" (one JSON object per line).
+    Returns:
+        tuple: (list of (line number, request), list of errors for invalid lines)
+    """
+    if kind == "csv":
+        reader = csv.DictReader(stream)
+        rows = ((reader.line_num, {k: v for k, v in row.items() if k and v}) for row in reader)
+    else:
+        rows = ((line, text) for line, text in enumerate(stream, 1) if text.strip())
+    entries, errors = [], []
+    for line, row in rows:
+        try:
+            entries.append((line, TTSRequest(**(json.loads(row) if isinstance(row, str) else row))))
+        except (ValueError, TypeError) as e:
+            errors.append({"line": line, "detail": str(e)})
+    return entries, errors
+
+def catalog_kind(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+class PrewarmJob:
+    """Synthesizes the missing entries of a catalog and tracks progress."""
+
+    def __init__(self, entries: list[tuple[int, TTSRequest]], errors: list[dict]):
+        self.id = os.urandom(6).hex()
+        self.entries = entries
+        self.total = len(entries) + len(errors)
+        self.cached = 0
+        self.synthesized = 0
+        self.failed = 0
+        self.errors = []
+        for error in errors:
+            self.fail(error["line"], error["detail"])
+        self.state = "pending"
+        self.started = time.time()
+        self.finished = None
+        self.task = None
+
+    def fail(self, line: int, detail: str):
+        self.failed += 1
+        if len(self.errors) < PREWARM_MAX_ERRORS:
+            self.errors.append({"line": line, "detail": detail})
+
+    async def warm(self, line: int, req: TTSRequest, limiter: asyncio.Semaphore):
+        fmt = req.audio_format()
+        text = normalize_text(req.text)
+        filename = compute_cache_filename(text, req.model, fmt)
+        try:
+            # The file may be on disk without being indexed yet
+            if await cache_lookup(filename) or await run_in_threadpool(tts_cache.adopt, filename):
+                self.cached += 1
+                return
+            async with limiter:
+                # Joins a synthesis live traffic may already have started
+                await single_flight(filename, lambda: synthesize_to_cache(text, req.model, local_storage.path(filename), fmt))
+            self.synthesized += 1
+        except Exception as e:
+            self.fail(line, str(e))
+
+    async def run(self, concurrency: int = PREWARM_CONCURRENCY):
+        """Warm every entry, with at most concurrency syntheses in flight."""
+        synthesis_priority.set(PRIORITY_PREWARM)
+        self.state = "running"
+        self.started = time.time()
+        limiter = asyncio.Semaphore(concurrency)
+        pending = iter(self.entries)
+
+        async def worker():
+            for line, req in pending:
+                await self.warm(line, req, limiter)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            self.state = "finished"
+        except asyncio.CancelledError:
+            self.state = "cancelled"
+            raise
+        finally:
+            self.finished = time.time()
+
+    def report(self) -> dict:
+        elapsed = (self.finished or time.time()) - self.started
+        done = self.cached + self.synthesized + self.failed
+        rate = done / elapsed if elapsed > 0 else 0.0
+        return {
+            "id": self.id,
+            "state": self.state,
+            "total": self.total,
+            "done": done,
+            "cached": self.cached,
+            "synthesized": self.synthesized,
+            "failed": self.failed,
+            "elapsed_seconds": round(elapsed, 3),
+            "entries_per_second": round(rate, 2),
+            "syntheses_per_second": round(self.synthesized / elapsed, 2) if elapsed > 0 else 0.0,
+            "eta_seconds": round((self.total - done) / rate, 1) if rate and self.state == "running" else None,
+            "errors": self.errors,
+        }
+
+# Jobs started through the admin endpoint, oldest first
+prewarm_jobs: OrderedDict[str, PrewarmJob] = OrderedDict()
+
+def check_admin(request: Request):
+    """Reject the request unless it carries the ADMIN_TOKEN bearer token."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.post("/admin/prewarm", status_code=202)
+async def start_prewarm(request: Request, file: UploadFile = File(...), concurrency: int = PREWARM_CONCURRENCY):
+    """
+    Start pre-warming the cache from an uploaded catalog (.csv or .jsonl, see
+    read_catalog) and return the job report; poll GET /admin/prewarm/{id}.
+    """
+    check_admin(request)
+    content = (await file.read()).decode("utf-8-sig")
+    entries, errors = await run_in_threadpool(read_catalog, io.StringIO(content), catalog_kind(file.filename or ""))
+    job = PrewarmJob(entries, errors)
+    job.task = asyncio.create_task(job.run(max(1, concurrency)))
+    prewarm_jobs[job.id] = job
+    # Forget the oldest finished jobs beyond PREWARM_MAX_JOBS
+    finished = [job_id for job_id, j in prewarm_jobs.items() if j.task.done()]
+    for job_id in finished[:max(0, len(prewarm_jobs) - PREWARM_MAX_JOBS)]:
+        del prewarm_jobs[job_id]
+    return job.report()
+
+@app.get("/admin/prewarm/{job_id}")
+async def get_prewarm(job_id: str, request: Request):
+    """Return the progress report of a pre-warming job."""
+    check_admin(request)
+    job = prewarm_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.report()
+
+@app.delete("/admin/prewarm/{job_id}")
+async def cancel_prewarm(job_id: str, request: Request):
+    """Stop a pre-warming job. Syntheses already in flight still complete."""
+    check_admin(request)
+    job = prewarm_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    job.task.cancel()
+    return job.report()
+
+async def prewarm_cli(argv: list[str]) -> int:
+    """Pre-warm the cache from a catalog file, printing progress to stderr and the final report to stdout."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python main.py prewarm", description="Synthesize a catalog into the TTS cache.")
+    parser.add_argument("catalog", help=".csv or .jsonl file of /tts request bodies")
+    parser.add_argument("--concurrency", type=int, default=PREWARM_CONCURRENCY, help="syntheses in flight")
+    parser.add_argument("--progress-seconds", type=float, default=5, help="interval between progress lines")
+    args = parser.parse_args(argv)
+
+    with open(args.catalog, encoding="utf-8-sig", newline="") as f:
+        entries, errors = read_catalog(f, catalog_kind(args.catalog))
+    # lifespan does not run here, so index the existing cache as it would
+    if not await run_in_threadpool(tts_cache.load):
+        await run_in_threadpool(tts_cache.scan)
+    job = PrewarmJob(entries, errors)
+    run = asyncio.create_task(job.run(max(1, args.concurrency)))
+    try:
+        while not run.done():
+            await asyncio.wait([run], timeout=args.progress_seconds)
+            report = job.report()
+            eta = f", eta {report['eta_seconds']}s" if report["eta_seconds"] is not None else ""
+            print(
+                f"{report['done']}/{report['total']} done: {report['cached']} cached, "
+                f"{report['synthesized']} synthesized, {report['failed']} failed, "
+                f"{report['entries_per_second']}/s{eta}",
+                file=sys.stderr,
+            )
+        await run
+    finally:
+        run.cancel()
+        if "deepgram_http" in globals():
+            await deepgram_http.aclose()
+    await run_in_threadpool(tts_cache.save)
+    print(json.dumps(job.report(), indent=2))
+    return 1 if job.failed else 0
+
+def migrate_cache_cli(argv: list[str]) -> int:
+    """Move flat cache folders into the sharded layout, printing what was moved."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python main.py migrate-cache",
+        description="Move cached audio from the old flat layout into shard directories. Safe while the app is running.",
+    )
+    parser.add_argument(
+        "folders", nargs="*", default=[audio_folder],
+        help=f"cache folders to migrate, e.g. a shared store directory (default: {audio_folder})",
+    )
+    args = parser.parse_args(argv)
+    for folder in args.folders:
+        moved, duplicates = migrate_flat_cache(folder)
+        print(f"{folder}: {moved} files moved, {duplicates} duplicates removed")
+    return 0
 
 
 # Load API key from environment variable
 api_key = os.getenv("google_api_key_gemini")
 
-# Initialize Gemini client
-client = genai.Client(api_key=api_key)
+# The Gemini client is built on first use (or by the startup preload)
+gemini_client_lock = threading.Lock()
+
+def gemini_client():
+    """Return the Gemini client, building it on first use. Thread-safe."""
+    global client
+    with gemini_client_lock:
+        if "client" not in globals():
+            from google import genai
+            client = genai.Client(api_key=api_key)
+    return client
+
+def __getattr__(name: str):
+    # Lets main.client and main.deepgram_http be used (or replaced) before first use
+    if name == "client":
+        return gemini_client()
+    if name == "deepgram_http":
+        return get_deepgram_http()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+PRELOAD_ON_STARTUP = env_flag("PRELOAD_ON_STARTUP", True)
+
+def preload():
+    """Import the lazily loaded libraries and build the Gemini client. Blocking."""
+    for name in ("numpy", "soundfile", "deepgram", "google.genai"):
+        importlib.import_module(name)
+    gemini_client()
+
+# Gemini model used for transcription
+TRANSCRIBE_MODEL = "gemini-2.0-flash-lite"
+
+# Maximum number of concurrent Gemini transcription calls per worker
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "8"))
+transcribe_semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+# Starlette spools uploaded files into a SpooledTemporaryFile while parsing
+# the form, which stays in memory up to TRANSCRIBE_SPOOL_BYTES and rolls over
+# to disk beyond that. Files up to TRANSCRIBE_INLINE_MAX_BYTES are sent inline
+# with the request; larger ones go through the Gemini Files API without being
+# read into memory.
+TRANSCRIBE_SPOOL_BYTES = int(os.getenv("TRANSCRIBE_SPOOL_BYTES", str(1024 * 1024)))
+MultiPartParser.spool_max_size = TRANSCRIBE_SPOOL_BYTES
+TRANSCRIBE_INLINE_MAX_BYTES = int(os.getenv("TRANSCRIBE_INLINE_MAX_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# The Gemini SDK reads file uploads in chunks of this size
+GEMINI_UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+
+def digest_upload(source) -> tuple[int, str]:
+    """
+    Hash an upload where Starlette spooled it, in fixed-size chunks, and rewind it.
+    Returns:
+        tuple: (size in bytes, SHA256 hex digest of the audio)
+    Blocking.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    while chunk := source.read(UPLOAD_CHUNK_BYTES):
+        hasher.update(chunk)
+        size += len(chunk)
+    source.seek(0)
+    return size, hasher.hexdigest()
 
-def transcribe_audio_directly(
+# Recordings longer than TRANSCRIBE_SEGMENT_MIN_SECONDS are cut at quiet
+# points into segments of roughly TRANSCRIBE_SEGMENT_SECONDS, which are
+# transcribed concurrently and stitched back together in order
+TRANSCRIBE_SEGMENT_MIN_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_MIN_SECONDS", "60"))
+TRANSCRIBE_SEGMENT_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", "30"))
+VAD_FRAME_SECONDS = 0.03
+# Frames decoded per block while measuring energy
+VAD_BLOCK_FRAMES = 1024
+
+def measure_audio(audio_file):
+    """
+    Decode audio_file block by block and measure the RMS energy of each
+    VAD frame of its mono mix.
+    Returns:
+        tuple: (per-frame energy, frame length in samples, sample rate,
+        total samples), or None if soundfile cannot decode the file
+    Blocking.
+    """
+    try:
+        with sf.SoundFile(audio_file) as f:
+            frame_len = max(1, int(f.samplerate * VAD_FRAME_SECONDS))
+            blocks = f.blocks(blocksize=frame_len * VAD_BLOCK_FRAMES, dtype="float32", always_2d=True)
+            energy = [frame_energy(block.mean(axis=1), frame_len) for block in blocks]
+            sample_rate, total_samples = f.samplerate, f.frames
+    except (sf.SoundFileError, TypeError):
+        return None
+    finally:
+        audio_file.seek(0)
+    energy = np.concatenate(energy) if energy else np.zeros(0, dtype="float32")
+    return energy, frame_len, sample_rate, total_samples
+
+def frame_energy(samples: np.ndarray, frame_len: int) -> np.ndarray:
+    """RMS energy of consecutive non-overlapping frames of a mono signal."""
+    n_frames = len(samples) // frame_len
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    return np.sqrt(np.mean(np.square(frames), axis=1))
+
+def find_split_points(energy: np.ndarray, segment_frames: int) -> list[int]:
+    """
+    Frame indices to cut at so segments are roughly segment_frames long:
+    each cut is the quietest frame between 0.5x and 1.5x the target length
+    after the previous cut.
+    """
+    cuts = []
+    start = 0
+    while len(energy) - start > segment_frames * 3 // 2:
+        low, high = start + segment_frames // 2, start + segment_frames * 3 // 2
+        start = low + int(np.argmin(energy[low:high]))
+        cuts.append(start)
+    return cuts
+
+def split_audio(energy: np.ndarray, frame_len: int, sample_rate: int, total_samples: int,
+                segment_seconds: float) -> list[tuple[int, int]]:
+    """
+    Cut the speech range of a recording at quiet points found in its frame
+    energy. Returns the (start, stop) sample range of every segment.
+    """
+    segment_frames = max(1, int(segment_seconds / VAD_FRAME_SECONDS))
+    start, stop = speech_bounds(energy, frame_len, sample_rate, total_samples)
+    cuts = [cut * frame_len for cut in find_split_points(energy, segment_frames)]
+    bounds = [start, *(cut for cut in cuts if start < cut < stop), stop]
+    return list(zip(bounds, bounds[1:]))
+
+def decode_segment(audio_file, start: int, stop: int) -> tuple[np.ndarray, int]:
+    """
+    Decode samples start to stop of audio_file.
+    Returns:
+        tuple: ((frames, channels) samples, sample rate)
+    Blocking.
+    """
+    with sf.SoundFile(audio_file) as f:
+        f.seek(start)
+        samples = f.read(stop - start, dtype="float32", always_2d=True)
+        rate = f.samplerate
+    audio_file.seek(0)
+    return samples, rate
+
+def encode_segment(samples: np.ndarray, rate: int) -> bytes:
+    """Preprocess decoded samples and encode them as OGG/Opus. Blocking."""
+    return encode_opus(*prepare_samples(samples, rate))
+
+# Before upload, audio is trimmed to its speech range (plus padding), mixed
+# down to mono and resampled to TRANSCRIBE_SAMPLE_RATE
+TRANSCRIBE_PREPROCESS = env_flag("TRANSCRIBE_PREPROCESS", True)
+TRANSCRIBE_SAMPLE_RATE = int(os.getenv("TRANSCRIBE_SAMPLE_RATE", "16000"))
+TRANSCRIBE_TRIM_PADDING_SECONDS = float(os.getenv("TRANSCRIBE_TRIM_PADDING_SECONDS", "0.25"))
+RESAMPLE_TAPS = 101
+
+def speech_bounds(energy: np.ndarray, frame_len: int, sample_rate: int, total_samples: int) -> tuple[int, int]:
+    """
+    Sample range from the first to the last frame at or above
+    TRANSCRIBE_SILENCE_DBFS, widened by TRANSCRIBE_TRIM_PADDING_SECONDS.
+    The whole file when preprocessing is off or no frame is loud enough.
+    """
+    loud = np.flatnonzero(energy >= 10 ** (TRANSCRIBE_SILENCE_DBFS / 20))
+    if not TRANSCRIBE_PREPROCESS or len(loud) == 0:
+        return 0, total_samples
+    padding = int(TRANSCRIBE_TRIM_PADDING_SECONDS * sample_rate)
+    start = max(0, int(loud[0]) * frame_len - padding)
+    stop = min(total_samples, (int(loud[-1]) + 1) * frame_len + padding)
+    return start, stop
+
+def resample(samples: np.ndarray, rate: int, target: int) -> np.ndarray:
+    """
+    Resample a mono signal by linear interpolation onto the target sample
+    grid. When downsampling, a windowed-sinc low-pass at the target Nyquist
+    frequency is applied first to avoid aliasing.
+    """
+    if rate == target or len(samples) == 0:
+        return samples
+    filtered = samples
+    if rate > target:
+        cutoff = 0.5 * target / rate
+        n = np.arange(RESAMPLE_TAPS) - (RESAMPLE_TAPS - 1) / 2
+        taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(RESAMPLE_TAPS)
+        filtered = np.convolve(samples, taps / taps.sum(), mode="same")
+    positions = np.arange(int(len(samples) * target / rate)) * (rate / target)
+    return np.interp(positions, np.arange(len(samples)), filtered).astype("float32")
+
+def prepare_samples(samples: np.ndarray, rate: int) -> tuple[np.ndarray, int]:
+    """Mix (frames, channels) samples down to mono at TRANSCRIBE_SAMPLE_RATE, if preprocessing is on."""
+    if not TRANSCRIBE_PREPROCESS:
+        return samples, rate
+    target = min(rate, TRANSCRIBE_SAMPLE_RATE)
+    return resample(samples.mean(axis=1), rate, target), target
+
+# Sample rates the Opus codec supports
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+def encode_opus(samples: np.ndarray, rate: int) -> bytes:
+    """
+    Encode samples as mono OGG/Opus, resampled to the lowest rate Opus
+    supports at or above rate. Compact enough that sending re-encoded
+    audio never costs much more than sending the upload.
+    """
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    target = next((r for r in OPUS_SAMPLE_RATES if r >= rate), OPUS_SAMPLE_RATES[-1])
+    buffer = io.BytesIO()
+    sf.write(buffer, resample(samples, rate, target), target, format="OGG", subtype="OPUS")
+    return buffer.getvalue()
+
+def preprocess_audio(audio_file, energy: np.ndarray, frame_len: int) -> tuple[bytes, int]:
+    """
+    Trim, downmix and resample audio_file and encode it as OGG/Opus.
+    Returns:
+        tuple: (Opus bytes, decoded sample bytes held)
+    Blocking.
+    """
+    with sf.SoundFile(audio_file) as f:
+        start, stop = speech_bounds(energy, frame_len, f.samplerate, f.frames)
+        f.seek(start)
+        samples = f.read(stop - start, dtype="float32", always_2d=True)
+        encoded = encode_opus(*prepare_samples(samples, f.samplerate))
+    audio_file.seek(0)
+    return encoded, samples.nbytes
+
+# Uploads whose loudest VAD frame is below TRANSCRIBE_SILENCE_DBFS are
+# answered locally as silent instead of being sent to Gemini
+TRANSCRIBE_SILENCE_DETECTION = env_flag("TRANSCRIBE_SILENCE_DETECTION", True)
+TRANSCRIBE_SILENCE_DBFS = float(os.getenv("TRANSCRIBE_SILENCE_DBFS", "-50"))
+
+def peak_dbfs(energy: np.ndarray) -> float:
+    """Level of the loudest frame in dBFS (-inf for empty or all-zero audio)."""
+    peak = float(energy.max()) if len(energy) else 0.0
+    return 20 * np.log10(peak) if peak > 0 else float("-inf")
+
+@dataclass
+class SegmentedTranscription:
+    transcription: str
+    is_successful: bool
+    segments: int
+    # Total size of the Opus segments sent
+    encoded_bytes: int
+    # Most decoded and encoded audio bytes held at once
+    peak_bytes: int
+
+async def transcribe_segmented(audio_file, energy: np.ndarray, frame_len: int, sample_rate: int,
+                               total_samples: int) -> SegmentedTranscription:
+    """
+    Split a long recording at silences and transcribe the segments
+    concurrently, joining the transcripts in order. Segments are encoded
+    lazily as OGG/Opus by TRANSCRIBE_CONCURRENCY workers, each encoding one
+    and sending it before taking the next, so at most that many encoded
+    segments are held at once. Decoding is serialized since the segments
+    share audio_file; encoding, the costly part, runs in parallel.
+    """
+    bounds = split_audio(energy, frame_len, sample_rate, total_samples, TRANSCRIBE_SEGMENT_SECONDS)
+    decode_lock = asyncio.Lock()
+    held = peak = 0
+
+    async def encode(index: int) -> bytes:
+        nonlocal held, peak
+        start, stop = bounds[index]
+        async with decode_lock:
+            samples, rate = await run_traced("transcribe.decode_segment", decode_segment, audio_file, start, stop)
+        held += samples.nbytes
+        segment = await run_traced("transcribe.encode_segment", encode_segment, samples, rate)
+        # The decoded samples are released once the segment is encoded
+        peak = max(peak, held + len(segment))
+        held += len(segment) - samples.nbytes
+        return segment
+
+    results: list[tuple[str, bool] | None] = [None] * len(bounds)
+    sizes = [0] * len(bounds)
+    pending = iter(range(len(bounds)))
+
+    async def worker():
+        nonlocal held
+        for index in pending:
+            segment = await encode(index)
+            sizes[index] = len(segment)
+            try:
+                results[index] = await transcribe_audio_directly(segment, "audio/ogg")
+            finally:
+                held -= len(segment)
+
+    await asyncio.gather(*(worker() for _ in range(min(TRANSCRIBE_CONCURRENCY, len(bounds)))))
+    transcription = " ".join(text for text, _ in results if text)
+    return SegmentedTranscription(transcription, bool(transcription), len(bounds), sum(sizes), peak)
+
+# Bump whenever the transcription system prompt changes, so cached
+# transcripts produced by the old prompt are no longer used
+TRANSCRIBE_PROMPT_VERSION = "1"
+
+TRANSCRIPT_CACHE_FOLDER = os.getenv("TRANSCRIPT_CACHE_FOLDER", "transcripts")
+TRANSCRIPT_CACHE_TTL_SECONDS = int(os.getenv("TRANSCRIPT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+TRANSCRIPT_MEMORY_CACHE_ENTRIES = int(os.getenv("TRANSCRIPT_MEMORY_CACHE_ENTRIES", "1024"))
+
+def compute_transcript_key(audio_digest: str, mime_type: str, model: str) -> str:
+    """Cache key of a transcription: audio content hash plus everything that affects the result."""
+    key = f"{audio_digest}:{mime_type}:{model}:{TRANSCRIBE_PROMPT_VERSION}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+class TranscriptCache:
+    """
+    Transcription results keyed by content hash: a bounded in-memory LRU in
+    front of one JSON file per result on disk. Entries expire after ttl
+    seconds and the disk tier is kept under max_bytes by evict().
+    """
+
+    def __init__(self, folder: str, ttl: int, max_bytes: int, memory_entries: int):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".json")
+
+    def remember(self, key: str, created: float, result: dict):
+        self.memory[key] = (created, result)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def load(self, key: str):
+        """Read a result from disk. Returns (created, result) or None. Blocking."""
+        try:
+            with open(self.path(key), encoding="utf-8") as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return record["created"], record["result"]
+
+    def store(self, key: str, created: float, result: dict):
+        """Write a result to disk atomically. Blocking."""
+        file_path = self.path(key)
+        tmp_path = make_temp_path(file_path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": created, "result": result}, f)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    async def get(self, key: str):
+        """Return the cached result for key, or None if it is missing or expired."""
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = await run_traced("transcript_cache.load", self.load, key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self.memory.pop(key, None)
+            stats["transcript_cache_misses"] += 1
+            return None
+        self.remember(key, *entry)
+        stats["transcript_cache_hits"] += 1
+        return entry[1]
+
+    async def put(self, key: str, result: dict):
+        created = time.time()
+        self.remember(key, created, result)
+        try:
+            await run_traced("transcript_cache.store", self.store, key, created, result)
+        except OSError:
+            logger.exception("Writing transcript cache entry %s failed", key)
+
+    def evict(self) -> int:
+        """Delete expired entries, then the oldest ones until under max_bytes. Returns the number removed."""
+        files = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+        cutoff = time.time() - self.ttl
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if mtime >= cutoff and (not self.max_bytes or total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        stats["transcript_cache_evictions"] += removed
+        return removed
+
+transcript_cache = TranscriptCache(
+    TRANSCRIPT_CACHE_FOLDER,
+    TRANSCRIPT_CACHE_TTL_SECONDS,
+    TRANSCRIPT_CACHE_MAX_BYTES,
+    TRANSCRIPT_MEMORY_CACHE_ENTRIES,
+)
+
+async def transcribe_audio_directly(
     audio_bytes: bytes,
     mime_type: str,
-    model: str = "gemini-2.0-flash-lite"
+    model: str = TRANSCRIBE_MODEL
+) -> tuple[str, bool]:
+    """
+    Transcribe audio bytes using Google Gemini API, sent inline with the request.
+    Returns:
+        tuple: (transcription text, is_successful)
+    """
+    from google.genai import types
+
+    # Wrap bytes in a Part object with correct MIME type
+    audio_part = types.Part.from_bytes(data=audio_bytes, mime_type=mime_type)
+    return await transcribe_part(audio_part, model)
+
+async def transcribe_audio_file(
+    audio_file,
+    mime_type: str,
+    model: str = TRANSCRIBE_MODEL
 ) -> tuple[str, bool]:
     """
-    Transcribe an audio file using Google Gemini API.
+    Transcribe a large audio file by uploading it through the Gemini Files API
+    in chunks, so it is never held in memory. The upload is deleted afterwards.
+    Returns:
+        tuple: (transcription text, is_successful)
+    """
+    from google.genai import types
+
+    client = gemini_client()
+    try:
+        async with track_upstream("gemini", "upload"):
+            uploaded = await client.aio.files.upload(file=audio_file, config={"mime_type": mime_type})
+            while uploaded.state == types.FileState.PROCESSING:
+                await asyncio.sleep(1)
+                uploaded = await client.aio.files.get(name=uploaded.name)
+    except Exception as e:
+        raise RuntimeError(f"Transcription failed: {str(e)}")
+    try:
+        audio_part = types.Part.from_uri(file_uri=uploaded.uri, mime_type=mime_type)
+        return await transcribe_part(audio_part, model)
+    finally:
+        try:
+            await client.aio.files.delete(name=uploaded.name)
+        except Exception:
+            logger.warning("Deleting uploaded file %s failed", uploaded.name)
+
+async def transcribe_part(audio_part: types.Part, model: str) -> tuple[str, bool]:
+    """
+    Transcribe an audio Part using Google Gemini API.
+    Uses the async Gemini client so the event loop keeps serving other
+    requests, with at most TRANSCRIBE_CONCURRENCY calls in flight.
     Returns:
         tuple: (transcription text, is_successful)
     """
     try:
-        # Wrap bytes in a Part object with correct MIME type
-        audio_part = types.Part.from_bytes(data=audio_bytes, mime_type=mime_type)
-        
         system_prompt = '''
 Please transcribe this audio accurately. If any email addresses, phone numbers, physical addresses, or similar details are detected, transcribe them carefully and standardize them to the correct format.
 
@@ -126,16 +3017,17 @@ if the audio is silent, return an empty string.
 '''
 
         # Call Gemini API
-        response = client.models.generate_content(
-            model=model,
-            contents=[
-                audio_part,
-                system_prompt
-            ],
-            config={
-                "temperature": 0
-            }
-        )
+        async with transcribe_semaphore, track_upstream("gemini", "generate_content"):
+            response = await gemini_client().aio.models.generate_content(
+                model=model,
+                contents=[
+                    audio_part,
+                    system_prompt
+                ],
+                config={
+                    "temperature": 0
+                }
+            )
 
         transcription = response.text.strip()
         # Set is_successful based on whether transcription is empty or not
@@ -149,18 +3041,102 @@ if the audio is silent, return an empty string.
 async def transcribe_audio(file: UploadFile = File(...)):
     try:
 
-        # Read the file contents into bytes
-        audio_bytes = await file.read()
-        start_time = time.time()
-        
-        # Call transcription function with correct mime type
-        transcription, is_successful = transcribe_audio_directly(audio_bytes, file.content_type)
-        end_time = time.time()
-        
+        # Work on the upload where Starlette spooled it rather than reading it whole
+        spool = file.file
+        size, audio_digest = await run_traced("transcribe.digest", digest_upload, spool)
+        # Audio bytes the spool holds in memory (none once it rolled over to disk)
+        spool_bytes = size if size <= TRANSCRIBE_SPOOL_BYTES else 0
+        try:
+            start_time = time.time()
+
+            # Identical audio was transcribed before: answer from the cache
+            key = compute_transcript_key(audio_digest, file.content_type, TRANSCRIBE_MODEL)
+            cached = await transcript_cache.get(key)
+            if cached is not None:
+                return JSONResponse(content={
+                    **cached,
+                    "time_taken": time.time() - start_time,
+                    "audio_bytes": size,
+                    "buffered_bytes": spool_bytes,
+                    "upload_mode": "cache",
+                    "cached": True
+                })
+
+            # Measure the audio locally when soundfile can decode it
+            measurement = await run_traced("transcribe.measure", measure_audio, spool)
+            if measurement is None:
+                stats["transcribe_undecodable"] += 1
+            else:
+                energy, frame_len, sample_rate, total_samples = measurement
+                level = peak_dbfs(energy)
+                stats["transcribe_silence_checked"] += 1
+                if TRANSCRIBE_SILENCE_DETECTION and level < TRANSCRIBE_SILENCE_DBFS:
+                    # Silent audio: skip the Gemini round trip entirely
+                    stats["transcribe_silent"] += 1
+                    return JSONResponse(content={
+                        "transcription": "",
+                        "is_successful": False,
+                        "time_taken": time.time() - start_time,
+                        "audio_bytes": size,
+                        "buffered_bytes": spool_bytes,
+                        "upload_mode": "silent",
+                        "peak_dbfs": round(level, 1) if np.isfinite(level) else None,
+                        "cached": False
+                    })
+
+            # Trim, downmix and resample short decodable audio, if that makes it smaller
+            processed = None
+            if measurement is not None and total_samples <= TRANSCRIBE_SEGMENT_MIN_SECONDS * sample_rate and TRANSCRIBE_PREPROCESS:
+                processed, peak_bytes = await run_traced("transcribe.preprocess", preprocess_audio, spool, energy, frame_len)
+                if len(processed) >= min(size, TRANSCRIBE_INLINE_MAX_BYTES + 1):
+                    processed = None
+
+            # Call transcription function with correct mime type
+            segment_count = 1
+            bytes_saved = 0
+            if measurement is not None and total_samples > TRANSCRIBE_SEGMENT_MIN_SECONDS * sample_rate:
+                segmented = await transcribe_segmented(spool, energy, frame_len, sample_rate, total_samples)
+                transcription, is_successful = segmented.transcription, segmented.is_successful
+                upload_mode = "segmented"
+                segment_count = segmented.segments
+                # Opus segments can still add up to more than a low-bitrate upload; never report a loss
+                bytes_saved = max(0, size - segmented.encoded_bytes)
+                # The spool, plus the decoded segment and encoded segments held at once
+                buffered_bytes = spool_bytes + segmented.peak_bytes
+            elif processed is not None:
+                transcription, is_successful = await transcribe_audio_directly(processed, "audio/ogg")
+                upload_mode = "preprocessed"
+                bytes_saved = size - len(processed)
+                # The spool, the decoded samples and the encoded upload
+                buffered_bytes = spool_bytes + peak_bytes + len(processed)
+            elif size <= TRANSCRIBE_INLINE_MAX_BYTES:
+                audio_bytes = await run_traced("transcribe.read", spool.read)
+                transcription, is_successful = await transcribe_audio_directly(audio_bytes, file.content_type)
+                upload_mode = "inline"
+                # The spool and the inline copy
+                buffered_bytes = spool_bytes + size
+            else:
+                transcription, is_successful = await transcribe_audio_file(spool, file.content_type)
+                upload_mode = "file"
+                # The spool and the chunk being uploaded
+                buffered_bytes = spool_bytes + min(size, GEMINI_UPLOAD_CHUNK_BYTES)
+            end_time = time.time()
+        finally:
+            await file.close()
+        stats["transcribe_peak_buffered_bytes"] = max(stats["transcribe_peak_buffered_bytes"], buffered_bytes)
+        stats["transcribe_bytes_saved"] += bytes_saved
+        await transcript_cache.put(key, {"transcription": transcription, "is_successful": is_successful})
+
         return JSONResponse(content={
             "transcription": transcription,
             "is_successful": is_successful,
-            "time_taken": end_time - start_time
+            "time_taken": end_time - start_time,
+            "audio_bytes": size,
+            "buffered_bytes": buffered_bytes,
+            "upload_mode": upload_mode,
+            "segments": segment_count,
+            "bytes_saved": bytes_saved,
+            "cached": False
         })
 
     except Exception as e:
@@ -168,5 +3144,9 @@ async def transcribe_audio(file: UploadFile = File(...)):
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["prewarm"]:
+        sys.exit(asyncio.run(prewarm_cli(sys.argv[2:])))
+    if sys.argv[1:2] == ["migrate-cache"]:
+        sys.exit(migrate_cache_cli(sys.argv[2:]))
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=6500, reload=True)
\ No newline at end of file